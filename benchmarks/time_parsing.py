@@ -0,0 +1,78 @@
+""" Per call cost of the timestamp parsing in field_parser on a recorded batch
+
+The timestamps (sidstOpdateret etc.) of the documents in a downloaded dump are parsed in document order with
+each of the transforms, like the parsers do. Record a batch with cvr_download (snapshot) or take lines of a JSONL dump:
+
+    python benchmarks/time_parsing.py cvr_batch.jsonl -n 10000
+"""
+import argparse
+import itertools
+import time
+from cvrparser.field_parser import slow_time_transform, fast_time_transform, utc_transform
+from cvrparser.snapshot import read_dump
+
+timestamp_fields = ('sidstOpdateret', 'sidstIndlaest', 'naermesteFremtidigeDato')
+
+
+def collect_timestamps(obj, out):
+    """ Timestamp strings of a document in document order
+
+    :param obj: dict or list, cvr document or part of it
+    :param out: list, timestamps are appended here
+    """
+    if isinstance(obj, dict):
+        for key, val in obj.items():
+            if key in timestamp_fields and isinstance(val, str):
+                out.append(val)
+            elif isinstance(val, (dict, list)):
+                collect_timestamps(val, out)
+    elif isinstance(obj, list):
+        for val in obj:
+            collect_timestamps(val, out)
+
+
+def time_transform(name, transform, timestamps, repeat):
+    """ Best of repeat runs over all timestamps
+
+    :return: float, nanoseconds per call
+    """
+    best = None
+    for _ in range(repeat):
+        if hasattr(transform, 'cache_clear'):
+            transform.cache_clear()
+        t0 = time.perf_counter()
+        for ts in timestamps:
+            transform(ts)
+        used = time.perf_counter() - t0
+        best = used if best is None else min(best, used)
+    per_call = best / len(timestamps) * 1e9
+    print('{0:<28} {1:10.0f} ns/call'.format(name, per_call))
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timestamp parsing benchmark')
+    parser.add_argument('filename', help='recorded batch - snapshot (.snap) or JSONL file')
+    parser.add_argument('-n', '--num_docs', type=int, default=10000, help='number of documents to read')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs of each transform - best is shown')
+    args = parser.parse_args()
+    timestamps = []
+    for doc in itertools.islice(read_dump(args.filename), args.num_docs):
+        collect_timestamps(doc, timestamps)
+    if len(timestamps) == 0:
+        print('No timestamps in {0}'.format(args.filename))
+        return
+    print('{0} timestamps, {1} distinct'.format(len(timestamps), len(set(timestamps))))
+    # the transforms must agree
+    for ts in set(timestamps[:1000]):
+        assert utc_transform.__wrapped__(ts) == fast_time_transform(ts), ts
+    slow = time_transform('dateutil', slow_time_transform, timestamps, 1)
+    fast = time_transform('manual (fast_time_transform)', fast_time_transform, timestamps, args.repeat)
+    time_transform('fromisoformat, no cache', utc_transform.__wrapped__, timestamps, args.repeat)
+    cached = time_transform('memoized (utc_transform)', utc_transform, timestamps, args.repeat)
+    print('memoized is {0:.1f}x faster than manual, {1:.1f}x faster than dateutil'.format(fast / cached,
+                                                                                          slow / cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ from . import (interactive_ensure_config_exists,
 from .elastic_cvr_extract import CvrConnection
 from .elastic_reg_extract import RegistrationConnection
 from . import cvr_makedb
+from . import commit_executor
 
 class Commands:
 
@@ -34,11 +35,23 @@ class Commands:
         
     
     @staticmethod
-    def update(use_address, resume, num_workers):
+    def update(use_address, resume, num_workers, slices, delta, overlap_hours, two_phase, async_io, route_by_type,
+               preload_dimensions, dimension_cache_mb, commit_workers, write_behind):
         interactive_ensure_config_exists()
         setup_database_connection()
         cvr = CvrConnection(update_address=use_address)
-        cvr.update_all(resume, num_workers)
+        cvr.update_all(resume, num_workers, slices, delta, overlap_hours, two_phase, async_io, route_by_type,
+                       preload_dimensions, dimension_cache_mb, commit_workers, write_behind)
+
+    @staticmethod
+    def replay(filename, use_address, num_workers, force, preload_dimensions, dimension_cache_mb, commit_workers):
+        interactive_ensure_config_exists()
+        setup_database_connection()
+        commit_executor.configure(commit_workers)
+        cvr = CvrConnection(update_address=use_address)
+        cvr.preload_dimensions = preload_dimensions
+        cvr.dimension_cache_bytes = dimension_cache_mb * 2**20
+        cvr.update_from_mixed_file(filename, force=force, workers=num_workers)
 
     @staticmethod
     def query(enh, cvr, pid, **general_options):
@@ -100,7 +113,90 @@ parser_update.add_argument('-n', '--num_workers',
                            default=3,
                            type=int
                            )
-
+parser_update.add_argument('-s', '--slices',
+                           dest='slices',
+                           help='number of parallel elasticsearch sliced scrolls (producer processes).',
+                           default=1,
+                           type=int
+                           )
+parser_update.add_argument('-d', '--delta',
+                           dest='delta',
+                           help='Only scan units updated since the last update (sidstOpdateret high-water mark).',
+                           default=False,
+                           action='store_true'
+                           )
+parser_update.add_argument('--overlap_hours',
+                           dest='overlap_hours',
+                           help='safety overlap in hours subtracted from the high-water mark in delta mode.',
+                           default=24,
+                           type=int
+                           )
+parser_update.add_argument('-t', '--two_phase',
+                           dest='two_phase',
+                           help='Find changed units with a light scan first, then download only those (-s fetchers). '
+                                'With -d the light scan only covers units updated since the high-water mark.',
+                           default=False,
+                           action='store_true'
+                           )
+parser_update.add_argument('--async_io',
+                           dest='async_io',
+                           help='Run the -s slices/fetchers as asyncio tasks in one producer.',
+                           default=False,
+                           action='store_true'
+                           )
+parser_update.add_argument('--route_by_type',
+                           dest='route_by_type',
+                           help='Give each unit type its own consumers (needs at least 3 workers).',
+                           default=False,
+                           action='store_true'
+                           )
+parser_update.add_argument('--write_behind',
+                           dest='write_behind',
+                           help='parsed batches each consumer may have waiting to be written while it parses the '
+                                'next. 0 parses and writes in turn.',
+                           default=1,
+                           type=int
+                           )
+parser_replay = subparsers.add_parser('replay', help='update data from a downloaded snapshot (.snap) or JSONL file')
+parser_replay.add_argument('filename',
+                           help='file made by cvr_download')
+parser_replay.add_argument('-a', '--use_address',
+                           dest='use_address',
+                           help='Enable Address Parsing - Requires Dawa download first - and is slower',
+                           default=False,
+                           action='store_true',
+                           )
+parser_replay.add_argument('-n', '--num_workers',
+                           dest='num_workers',
+                           help='number of processes replaying the file in parallel.',
+                           default=3,
+                           type=int
+                           )
+parser_replay.add_argument('-f', '--force',
+                           dest='force',
+                           help='Update all units in file - do not compare samtId with the database.',
+                           default=False,
+                           action='store_true'
+                           )
+for sub_parser in (parser_update, parser_replay):
+    sub_parser.add_argument('--preload_dimensions',
+                            dest='preload_dimensions',
+                            help='Read names, contact info, brancher etc. into memory when each worker starts.',
+                            default=False,
+                            action='store_true'
+                            )
+    sub_parser.add_argument('--dimension_cache_mb',
+                            dest='dimension_cache_mb',
+                            help='memory cap in MB of the name and contact info caches of each worker.',
+                            default=512,
+                            type=int
+                            )
+    sub_parser.add_argument('--commit_workers',
+                            dest='commit_workers',
+                            help='threads writing to the database in each worker (each uses a pooled connection).',
+                            default=commit_executor.default_workers,
+                            type=int
+                            )
 
 parser_dawa = subparsers.add_parser('dawa',
                                     help='Download dawa address info and insert into sql database')
@@ -240,6 +240,13 @@ class Lastupdated(Base):
     lastupdated = Column(DateTime, nullable=False)
 
 
+class Scancursor(Base):
+    __tablename__ = "ScanCursor"
+    scantype = Column(String(255, 'utf8mb4_bin'), primary_key=True)
+    cursor = Column(Text, nullable=False)
+    updated = Column(DateTime, nullable=False)
+
+
 class Livsforloeb(Base):
     __tablename__ = 'Livsforloeb'
     __table_args__ = (
@@ -426,6 +433,8 @@ class CreateDatabase(object):
                            Kontaktinfo,
                            Kvartalsbeskaeftigelse,
                            erstKvartalsbeskaeftigelse,
+                           Lastupdated,
+                           Scancursor,
                            Livsforloeb,
                            Maanedsbeskaeftigelse,
                            erstMaanedsbeskaeftigelse,
@@ -0,0 +1,194 @@
+""" Asyncio producer for the cvr update
+
+One process keeps all scroll slices and id fetches in flight at the same time on one pooled
+elasticsearch client, instead of a producer process for each. The pages are put on the queue as raw page frames,
+which the consumers expand into (dict_type, dat, full_update) tuples like for the other producers.
+
+The requests are made with the raw elasticsearch client on a thread for each request in flight (AsyncClient).
+The elasticsearch-async package is not used - its last release does not run on python 3.10 and later.
+"""
+import asyncio
+import functools
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch_dsl import Search
+from .elastic_cvr_extract import CvrConnection, create_elastic_connection, producer_logger, put_page
+from .frames import page_info, PAGE_SCAN, PAGE_FULL
+from .page_size import AdaptivePageSize
+
+
+class AsyncClient(object):
+    """ Awaitable search, scroll and clear_scroll of a raw elasticsearch client (responses are not decoded).
+    Each request runs on a thread of its own pool - the client and its connection pool are thread safe
+    and the threads wait for the network without holding the GIL.
+    """
+
+    def __init__(self, url, authentication, connections):
+        """
+        :param url: str, elasticsearch url
+        :param authentication: (user, password)
+        :param connections: int, number of requests in flight - threads and pooled connections
+        """
+        self.client = create_elastic_connection(url, authentication, raw=True, maxsize=connections)
+        self.pool = ThreadPoolExecutor(max_workers=connections)
+
+    async def request(self, method, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(self.pool, functools.partial(method, **kwargs))
+
+    async def search(self, **kwargs):
+        return await self.request(self.client.search, **kwargs)
+
+    async def scroll(self, **kwargs):
+        return await self.request(self.client.scroll, **kwargs)
+
+    async def clear_scroll(self, **kwargs):
+        return await self.request(self.client.clear_scroll, **kwargs)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.client.transport.close()
+
+
+class AsyncProducer(object):
+    """ Runs the scroll slices or id fetches as tasks on one event loop """
+
+    def __init__(self, queues, logger, includes=None, by_type=False):
+        """
+        :param queues: list of queues, one for each consumer
+        :param logger: logging.Logger
+        :param includes: list, _source includes - None for complete documents
+        :param by_type: bool, route units to consumers by type too
+        """
+        self.queues = queues
+        self.logger = logger
+        self.includes = includes
+        self.by_type = by_type
+        self.cvr = CvrConnection()
+        self.client = None
+        self.loop = None
+        # one thread puts all pages - the queues are not shared by threads
+        self.put_executor = None
+        self.docs = 0
+
+    async def put(self, kind, page, hits):
+        """ Split page and put it on the queues in a thread so the other requests are not blocked """
+        await self.loop.run_in_executor(self.put_executor, put_page, self.queues, kind, page, self.logger, None,
+                                        self.by_type)
+        self.docs += hits
+
+    async def scroll_slice(self, query, slice_id, slices):
+        """ Scroll through one slice of the index
+
+        :param query: dict, search body
+        :param slice_id: int, slice to scan
+        :param slices: int, total number of slices
+        """
+        name = 'async slice {0}/{1}'.format(slice_id, slices)
+        body = dict(query)
+        if slices > 1:
+            body['slice'] = {'id': slice_id, 'max': slices}
+        scroll = self.cvr.elastic_search_scroll_time
+        page_size = AdaptivePageSize(size=self.cvr.elastic_search_scan_size, adapt=False, name=name,
+                                     logger=self.logger)
+        t0 = time.time()
+        page = await self.client.search(index=self.cvr.index, body=body, scroll=scroll, size=page_size.size)
+        scroll_id, hits = page_info(page)
+        page_size.record(hits, len(page), time.time() - t0)
+        try:
+            while hits > 0:
+                await self.put(PAGE_SCAN, page, hits)
+                t0 = time.time()
+                page = await self.client.scroll(body={'scroll_id': scroll_id, 'scroll': scroll})
+                scroll_id, hits = page_info(page)
+                page_size.record(hits, len(page), time.time() - t0)
+        finally:
+            if scroll_id is not None:
+                await self.client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+            page_size.summary()
+
+    async def fetch_ids(self, enh, fetch_id):
+        """ Download units with ids queries
+
+        :param enh: list, enhedsnummer of units to download
+        :param fetch_id: int, id of fetcher - used for logging
+        """
+        page_size = AdaptivePageSize(size=256, max_size=2048, name='async fetch {0}'.format(fetch_id),
+                                     logger=self.logger)
+        i = 0
+        while i < len(enh):
+            batch = enh[i:i + page_size.size]
+            i += len(batch)
+            body = {'query': {'ids': {'values': batch}}, 'size': len(batch)}
+            if self.includes is not None:
+                body['_source'] = self.includes
+            t0 = time.time()
+            page = await self.client.search(index=self.cvr.index, body=body)
+            _, hits = page_info(page)
+            page_size.record(len(batch), len(page), time.time() - t0)
+            await self.put(PAGE_FULL, page, hits)
+        page_size.summary()
+
+    async def run(self, slices=1, since=None, enh=None):
+        """ Run all slices or fetchers concurrently
+
+        :param slices: int, number of scroll slices or id fetchers in flight
+        :param since: dict, unit type -> utc datetime to scan from, None for full scan
+        :param enh: list, enhedsnummer of units to fetch (two phase update) - None to scan
+        """
+        self.loop = asyncio.get_event_loop()
+        self.client = AsyncClient(self.cvr.url, (self.cvr.user, self.cvr.password), slices)
+        self.put_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            if enh is not None:
+                tasks = [self.fetch_ids(enh[fetch_id::slices], fetch_id) for fetch_id in range(slices)]
+            else:
+                if since is None:
+                    search = Search(index=self.cvr.index).query('match_all')
+                else:
+                    search = Search(index=self.cvr.index).query(CvrConnection.make_delta_query(since))
+                if self.includes is not None:
+                    search = search.source(self.includes)
+                query = search.to_dict()
+                tasks = [self.scroll_slice(query, slice_id, slices) for slice_id in range(slices)]
+            await asyncio.gather(*tasks)
+        finally:
+            self.client.close()
+            self.put_executor.shutdown(wait=True)
+
+
+def cvr_async_producer(queues, lock, slices=1, since=None, newest=None, includes=None, enh=None, by_type=False):
+    """ Producer process that runs the scroll slices (or id fetches) as asyncio tasks
+
+    :param queues: list of queues, one for each consumer
+    :param lock: multiprocessing.Lock
+    :param slices: int, number of scroll slices or id fetchers in flight
+    :param since: dict, unit type -> utc datetime to scan from, None for full scan
+    :param newest: dict like (multiprocessing.Manager), set failed here if the download fails
+    :param includes: list, _source includes - None for complete documents
+    :param enh: list, enhedsnummer of units to fetch (two phase update) - None to scan
+    :param by_type: bool, route units to consumers by type too
+    """
+    t0 = time.time()
+    logger = producer_logger('async-producer')
+    with lock:
+        logger.info('Starting async producer - {0} in flight => {1}'.format(slices, os.getpid()))
+    producer = AsyncProducer(queues, logger, includes, by_type)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(producer.run(slices, since, enh))
+    except Exception as e:
+        print('*** async producer error ***', file=sys.stderr)
+        logger.debug('async producer error: {0}'.format(str(e)))
+        print(e)
+        if newest is not None:
+            newest['failed'] = True
+        return
+    finally:
+        loop.close()
+        for queue in queues:
+            queue.close()
+    with lock:
+        logger.info('Async Producer Done. {0} docs - Time Used: {1}'.format(producer.docs, time.time() - t0))
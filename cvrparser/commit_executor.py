@@ -0,0 +1,107 @@
+""" Long lived, bounded thread pool for the parser commits and deletes of the update batches
+
+Each batch used to start a thread (and check out a connection) for every parser and every table it deletes from.
+Now the work runs on a pool that lives as long as the process. Tasks are submitted with a key (the table they write);
+tasks with the same key run one at a time in submission order, tasks with different keys run in parallel on at most
+workers threads - so at most workers connections of the engine pool are used by the commits at any time.
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+default_workers = 8
+
+
+class CommitExecutor(object):
+    """ Thread pool with per key ordering """
+
+    def __init__(self, workers=default_workers):
+        """
+        :param workers: int, number of threads
+        """
+        self.workers = workers
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+        # key -> tasks waiting for the running task with the same key
+        self.waiting = {}
+        self.local = threading.local()
+
+    def get_pool(self):
+        if self.pool is None or self.pid != os.getpid():
+            # threads do not survive fork - each process makes its own pool
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.waiting = {}
+        return self.pool
+
+    def configure(self, workers):
+        """ Set number of threads - the pool is made again on next use
+
+        :param workers: int, number of threads
+        """
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.shutdown(wait=True)
+        self.pool = None
+        self.workers = workers
+
+    def submit(self, key, fn):
+        """ Run fn after the tasks with the same key submitted before it
+
+        :param key: hashable, e.g. the table class written by fn
+        :param fn: function without arguments
+        :return: concurrent.futures.Future
+        """
+        pool = self.get_pool()
+        future = Future()
+        with self.lock:
+            if key in self.waiting:
+                self.waiting[key].append((future, fn))
+                return future
+            self.waiting[key] = deque()
+        pool.submit(self.run_key, key, future, fn)
+        return future
+
+    def run_key(self, key, future, fn):
+        """ Run task and then the tasks that are waiting for it """
+        self.local.in_pool = True
+        while True:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.lock:
+                if len(self.waiting[key]) == 0:
+                    del self.waiting[key]
+                    return
+                future, fn = self.waiting[key].popleft()
+
+    def run(self, tasks):
+        """ Run tasks and wait for all of them - the first error is raised when they are done
+
+        :param tasks: list of (key, function) tuples
+        """
+        if getattr(self.local, 'in_pool', False):
+            # called from a task - waiting for the pool here could deadlock it
+            for (key, fn) in tasks:
+                fn()
+            return
+        futures = [self.submit(key, fn) for (key, fn) in tasks]
+        errors = [f.exception() for f in futures]
+        for e in errors:
+            if e is not None:
+                raise e
+
+
+commit_executor = CommitExecutor()
+
+
+def configure(workers):
+    commit_executor.configure(workers)
+
+
+def run(tasks):
+    commit_executor.run(tasks)
@@ -5,19 +5,28 @@ import ujson as json
 import logging
 import argparse
 import tqdm
+from .snapshot import SnapshotWriter, is_snapshot
 
 
 def download_all_dicts_to_file(filename, search, mode='w'):
     """ Download data from elastic search server
+    Files ending with .snap are written as compressed indexed snapshots (see snapshot.py), other files as JSONL.
 
     :param filename: str, name of file to save data
     :param search: elasticsearch search object to query
-    :param mode, char, file write mode (w, a)
+    :param mode, char, file write mode (w, a) - snapshots can not be appended to
     :return filename, str:
     """
     print('Download Data Write to File')
     print('ElasticSearch Download Scan Query: ', str(search.to_dict())[0:1000], ' ...')
     generator = search.scan()
+    if is_snapshot(filename):
+        assert mode == 'w', 'snapshots can not be appended to'
+        with SnapshotWriter(filename) as writer:
+            for obj in tqdm.tqdm(generator):
+                writer.add(obj.to_dict())
+        print('Snapshot Downloaded - File {0} written - {1}'.format(filename, writer.counts))
+        return filename
     with open(filename, mode) as f:
         for obj in tqdm.tqdm(generator):
             json.dump(obj.to_dict(), f)
@@ -31,7 +40,7 @@ if __name__ == '__main__':
     parser.add_argument('-user',  dest='cvruser', help='elastic user', type=str, default='dummy')
     parser.add_argument('-pass', dest='cvrpass', help='elastic password', type=str, default='dummy')
     args = parser.parse_args()
-    # command line arguments run with python cvr_download.py -u <username> -p <password>
+    # command line arguments run with python -m cvrparser.cvr_download -user <username> -pass <password>
     logging.basicConfig(level=logging.INFO)
 
     url = 'http://distribution.virk.dk:80'
@@ -44,7 +53,7 @@ if __name__ == '__main__':
     # server keep alive time
     elastic_search_scroll_time = u'5m'
     # place to store file
-    json_filename = os.path.join('./', 'cvr_all.json')
+    json_filename = os.path.join('./', 'cvr_all.snap')
     # set elastic search params
     params = {'scroll': elastic_search_scroll_time, 'size': elastic_search_scan_size}
     # create elasticsearch search object
@@ -1,4 +1,6 @@
 from sqlalchemy import tuple_
+from collections import OrderedDict
+import sys
 from . import parser_company as virksomhed_parser
 from . import parser_person as person_parser
 from . import parser_punit as penhed_parser
@@ -6,6 +8,8 @@ from . import field_parser as field_parser
 from . import adresse
 from . import alchemy_tables
 from . import Session
+from .bug_report import add_error
+from .sql_help import stream_query
 
 
 def insert_values(dicts, parser):
@@ -79,13 +83,76 @@ def get_emp_parser():
 
 
 class Mapping(object):
-    """ Simple mapping object that maps values to database ids that caches updates"""
-    def __init__(self, keycol, val, keylen=1):
-        self.mapped = {}
+    """ Simple mapping object that maps values to database ids that caches updates
+    With max_bytes the mapped values are kept in least recently used order and the oldest are evicted when
+    the estimated size is above max_bytes. Evicted values are looked up in the database again if they are needed.
+    """
+    # rough size of an entry besides the key: dict slot, id and bookkeeping
+    entry_overhead = 120
+
+    def __init__(self, keycol, val, keylen=1, max_bytes=None):
+        """
+        :param keycol: column or tuple of columns, key in table
+        :param val: column, id in table
+        :param keylen: int, number of key columns
+        :param max_bytes: int, memory cap of the mapped values - None for no cap
+        """
+        self.mapped = {} if max_bytes is None else OrderedDict()
         self.unmapped = set()
         self.val = val
         self.keycol = keycol
         self.keylen = keylen
+        # names of the key columns
+        self.key_fields = [x.name for x in keycol] if keylen > 1 else [keycol.name]
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def entry_size(self, key):
+        if type(key) is tuple:
+            return self.entry_overhead + sum(sys.getsizeof(x) for x in key)
+        return self.entry_overhead + sys.getsizeof(key)
+
+    def store(self, new):
+        """ Add mapped values - evicting the least recently used above max_bytes
+
+        :param new: dict, value -> id
+        """
+        if self.max_bytes is None:
+            self.mapped.update(new)
+            return
+        for key, _id in new.items():
+            if key in self.mapped:
+                self.mapped.move_to_end(key)
+            else:
+                self.bytes += self.entry_size(key)
+            self.mapped[key] = _id
+        while self.bytes > self.max_bytes and len(self.mapped) > 0:
+            key, _ = self.mapped.popitem(last=False)
+            self.bytes -= self.entry_size(key)
+
+    def preload(self, session=None):
+        """ Read the table into the map (until max_bytes is reached) - streamed in chunks
+
+        :param session: sqlalchemy session
+        :return: int, number of mapped values
+        """
+        close = session is None
+        if session is None:
+            session = Session()
+        if self.keylen == 1:
+            query = session.query(self.keycol, self.val)
+        else:
+            query = session.query(*self.keycol, self.val)
+        for chunk in stream_query(query):
+            if self.keylen == 1:
+                self.store({x[0]: x[-1] for x in chunk})
+            else:
+                self.store({tuple(x[:self.keylen]): x[-1] for x in chunk})
+            if self.max_bytes is not None and self.bytes >= self.max_bytes:
+                break
+        if close:
+            session.close()
+        return len(self.mapped)
 
     def update(self, session=None):
         """ Update the keys of all the unmapped values
@@ -98,13 +165,14 @@ class Mapping(object):
         # logging.info('update keystore len: {0}\n{1}'.format(len(self.unmapped), list(self.unmapped)[0:2]))
         missing = set()
         if len(self.unmapped) > 0:
-            self.unmapped = self.unmapped
+            # values may be added by a parser in another thread meanwhile (write behind) - they stay unmapped
+            unmapped = set(self.unmapped)
             if session is None:
                 session = Session()
             if self.keylen == 1:
-                query = session.query(self.keycol, self.val).filter(self.keycol.in_(self.unmapped))
+                query = session.query(self.keycol, self.val).filter(self.keycol.in_(unmapped))
             else:
-                query = session.query(*self.keycol, self.val).filter(tuple_(*self.keycol).in_(self.unmapped))
+                query = session.query(*self.keycol, self.val).filter(tuple_(*self.keycol).in_(unmapped))
             qres = query.all()
             res = [x for x in qres]
             if self.keylen == 1:
@@ -113,26 +181,50 @@ class Mapping(object):
                 # new = {x[:self.keylen]: x[self.keylen:] for x in res}
                 new = {x[:self.keylen]: x[-1] for x in res}
             new_keys = set(new.keys())
-            if not new_keys.issubset(self.unmapped):
+            if not new_keys.issubset(unmapped):
                 print('new_keys not in unmapped: {0} - {1}'.format(self.keycol, self.val))
-                print('unmapped', len(self.unmapped), self.unmapped)
+                print('unmapped', len(unmapped), unmapped)
                 print('new keys', len(new_keys), new_keys)
                 print('new', len(new), new)
                 print('lens compared', len(res), len(new))
-                print('difference new_keys.difference(self.unmapped)', new_keys.difference(self.unmapped))
-                print('difference self.unmapped.difference(new_keys)', self.unmapped.difference(new_keys))
+                print('difference new_keys.difference(unmapped)', new_keys.difference(unmapped))
+                print('difference unmapped.difference(new_keys)', unmapped.difference(new_keys))
                 add_error('Mapping update fail')
                 assert False, "Key errors related to trailing white space mysql issue most likely"
-            missing = self.unmapped - set(new.keys())
-            self.mapped.update(new)
-            self.unmapped = missing
+            missing = unmapped - new_keys
+            self.resolve(new)
         return missing
 
+    def resolve(self, new):
+        """ Map values that were unmapped
+
+        :param new: dict, value -> id
+        """
+        # mapped before it is removed from unmapped so it is always in one of them
+        self.store(new)
+        self.unmapped.difference_update(new.keys())
+
     def __getitem__(self, key):
+        if self.max_bytes is None:
+            return self.mapped[key]
+        if key not in self.mapped:
+            # evicted - look it up again
+            self.unmapped.add(key)
+            self.update()
+            self.unmapped.discard(key)
+        self.mapped.move_to_end(key)
         return self.mapped[key]
 
     def __contains__(self, key):
-        return key in self.mapped or key in self.unmapped
+        if key in self.mapped:
+            if self.max_bytes is not None:
+                try:
+                    self.mapped.move_to_end(key)
+                except KeyError:
+                    # evicted meanwhile by another thread - still in the database
+                    pass
+            return True
+        return key in self.unmapped
 
     def add(self, obj):
         self.unmapped.add(obj)
@@ -140,11 +232,18 @@ class Mapping(object):
 
 class KeyStore(object):
 
-    def __init__(self):
+    def __init__(self, preload=False, max_bytes=None):
+        """
+        :param preload: bool, read the dimension tables into memory now instead of looking values up as they are seen
+        :param max_bytes: int, memory cap of the large mappings (names and contact info), half each - None for no cap
+        """
+        large_bytes = max_bytes // 2 if max_bytes is not None else None
         self.name_mapping = Mapping(val=alchemy_tables.Navne.navnid,
-                                    keycol=alchemy_tables.Navne.navn)
+                                    keycol=alchemy_tables.Navne.navn,
+                                    max_bytes=large_bytes)
         self.kontakt_mapping = Mapping(val=alchemy_tables.Kontaktinfo.oplysningid,
-                                       keycol=alchemy_tables.Kontaktinfo.kontaktoplysning)
+                                       keycol=alchemy_tables.Kontaktinfo.kontaktoplysning,
+                                       max_bytes=large_bytes)
         self.regnummer_mapping = Mapping(val=alchemy_tables.Regnummer.regid,
                                          keycol=alchemy_tables.Regnummer.regnummer)
         self.virksomhedsstatus_mapping = Mapping(val=alchemy_tables.Virksomhedsstatus.virksomhedsstatusid,
@@ -158,6 +257,17 @@ class KeyStore(object):
         self.branche_mapping = Mapping(val=alchemy_tables.Branche.brancheid,
                                        keylen=2,
                                        keycol=(alchemy_tables.Branche.branchekode, alchemy_tables.Branche.branchetekst))
+        if preload:
+            self.preload()
+
+    def preload(self):
+        """ Read the dimension tables into the mappings """
+        session = Session()
+        try:
+            sizes = [(mapping.val.class_.__name__, mapping.preload(session)) for mapping in self.mappings()]
+        finally:
+            session.close()
+        print('Dimension caches preloaded: {0}'.format(', '.join('{0} {1}'.format(k, n) for (k, n) in sizes)))
 
     def get_virksomhedsform_mapping(self):
         self.virksomhedsform_mapping.update()
@@ -187,14 +297,28 @@ class KeyStore(object):
         self.status_mapping.update()
         return self.status_mapping
 
+    def mappings(self):
+        return [self.name_mapping, self.kontakt_mapping, self.regnummer_mapping, self.virksomhedsstatus_mapping,
+                self.status_mapping, self.virksomhedsform_mapping, self.branche_mapping]
+
+    def update(self):
+        """ Map values added since the last update - only mappings with unmapped values query the database """
+        for mapping in self.mappings():
+            mapping.update()
+
 
 class DataParser(object):
-    """ Wrapper class for data parsers to store cache between uses"""
-    def __init__(self, _type):
+    """ Wrapper class for data parsers to store cache between uses.
+    The parser pipelines are made on first use and reused for all later batches, so the key store stays warm
+    and only values not seen before are looked up or inserted in the database.
+    """
+    def __init__(self, _type, keystore=None):
         """
         :param _type: str, cvr object type
+        :param keystore: KeyStore, shared with the parsers of the other types - None for a new one
         """
-        self.keystore = KeyStore()
+        self.keystore = keystore if keystore is not None else KeyStore()
+        self.parsers = {}
         self._type = _type
         if _type == 'Vrvirksomhed':
             self.data_parser = get_company_data_parsers
@@ -214,17 +338,88 @@ class DataParser(object):
         else:
             raise Exception('Bad Type {0}'.format(_type))
 
+    def get_parser(self, name):
+        """ Parser pipeline - made once and reused
+
+        :param name: str, data_parser, dynamic_parser, static_parser or employment_parser
+        :return: ParserInterface
+        """
+        if name not in self.parsers:
+            if name == 'employment_parser':
+                self.parsers[name] = self.employment_parser()
+            else:
+                self.parsers[name] = getattr(self, name)(self.keystore)
+        return self.parsers[name]
+
+    def parse(self, dicts, row_parsers=()):
+        """ Parse batch with one pass over the documents - every parser sees each document once.
+        The only barrier is dimension resolution: the value parsers insert the new names, contacts,
+        brancher, status codes... and these are mapped to ids before the rows referring to them are written.
+
+        :param dicts: list of dicts with cvr data
+        :param row_parsers: list of extra parsers for the same documents, e.g. the address parser
+        """
+        self.write_rows(self.parse_rows(dicts, row_parsers))
+
+    def parse_rows(self, dicts, row_parsers=()):
+        """ The parsing half of parse - the rows are kept in the parsers until write_rows.
+        Only reads (and adds unmapped values to) the key store, so it can run while another parser set of the
+        same key store is writing.
+
+        :param dicts: list of dicts with cvr data
+        :param row_parsers: list of extra parsers for the same documents, e.g. the address parser
+        :return: list of parsers holding rows, value parser first
+        """
+        parsers = [self.get_parser('data_parser'), self.get_parser('dynamic_parser')] + list(row_parsers)
+        parsers.append(self.get_parser('static_parser'))
+        for d in dicts:
+            for parser in parsers:
+                parser.insert(d)
+        return parsers
+
+    def write_rows(self, parsers):
+        """ The writing half of parse - the dimension values first, then the rows referring to them
+
+        :param parsers: list of parsers from parse_rows
+        """
+        parsers[0].commit()
+        self.keystore.update()
+        rows = field_parser.ParserList()
+        for parser in parsers[1:]:
+            rows.add_listener(parser)
+        rows.commit()
+
     def parse_data(self, dicts):
-        insert_values(dicts, self.data_parser(self.keystore))
+        insert_values(dicts, self.get_parser('data_parser'))
 
     def parse_dynamic_data(self, dicts):
-        insert_values(dicts, self.dynamic_parser(self.keystore))
+        # map the values inserted by parse_data before they are looked up
+        self.keystore.update()
+        insert_values(dicts, self.get_parser('dynamic_parser'))
 
     def parse_static_data(self, dicts):
-        insert_values(dicts, self.static_parser(self.keystore))
+        insert_values(dicts, self.get_parser('static_parser'))
 
     def parse_employment(self, dicts):
-        insert_values(dicts, self.employment_parser())
+        insert_values(dicts, self.get_parser('employment_parser'))
+
+    def source_fields(self):
+        """ Top level fields of the cvr unit read by the parsers
+
+        :return: set of str, None if some parser does not declare its fields
+        """
+        parsers = [self.get_parser('data_parser'),
+                   self.get_parser('dynamic_parser'),
+                   self.get_parser('static_parser')]
+        if self.employment_parser is not None:
+            parsers.append(self.get_parser('employment_parser'))
+        fields = set()
+        for parser in parsers:
+            parser_fields = parser.source_fields()
+            if parser_fields is None:
+                return None
+            fields.update(parser_fields)
+        return fields
 
 class RegistrationParser():
 
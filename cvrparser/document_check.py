@@ -0,0 +1,123 @@
+""" Cheap structural check of the downloaded cvr units before they are parsed
+
+A unit without one of the fields the parsers index (or with null instead of a list) used to fail deep inside the
+parsers, and the consumer then updated its whole batch again one unit at a time. Now such units are caught when they
+are sorted and written to a quarantine file instead, so the batches stay clean.
+The quarantine file is JSONL with a downloaded document on each line, so it can be replayed (see replay) when fixed.
+"""
+import datetime
+import os
+import threading
+import ujson as json
+from .bug_report import add_error
+
+# list fields the parsers read without a default - for the list fields with entries that are indexed without
+# a check, the keys of the entries
+address_fields = {'beliggenhedsadresse': (), 'postadresse': ()}
+contact_fields = {'elektroniskPost': (), 'telefonNummer': (), 'telefaxNummer': (), 'hjemmeside': (),
+                  'obligatoriskEmail': ()}
+branche_fields = {'hovedbranche': (), 'bibranche1': (), 'bibranche2': (), 'bibranche3': ()}
+spalt_fusion_keys = ('enhedsNummerOrganisation', 'organisationsNavn', 'indgaaende', 'udgaaende')
+required_lists = {
+    'Vrvirksomhed': dict(navne=(), binavne=(), attributter=(), livsforloeb=(), deltagerRelation=(),
+                         penheder=(), regNummer=(), status=(), virksomhedsform=(), virksomhedsstatus=(),
+                         spaltninger=spalt_fusion_keys, fusioner=spalt_fusion_keys,
+                         **contact_fields, **branche_fields, **address_fields),
+    'Vrdeltagerperson': dict(navne=(), attributter=(), **contact_fields, **address_fields),
+    'VrproduktionsEnhed': dict(navne=(), attributter=(), livsforloeb=(),
+                               **contact_fields, **branche_fields, **address_fields),
+}
+
+
+def check_unit(dict_type, dat, full_update=True):
+    """ Find the structural problems of a unit that would make the parsers fail
+
+    :param dict_type: str, cvr object type
+    :param dat: dict, cvr unit
+    :param full_update: bool, full update or employment only - employment only only needs enhedsNummer
+    :return: list of str, the problems - empty if the unit can be parsed
+    """
+    problems = []
+    if not isinstance(dat.get('enhedsNummer', None), int):
+        problems.append('enhedsNummer not int: {0}'.format(dat.get('enhedsNummer', None)))
+    if not full_update:
+        return problems
+    for field, keys in required_lists[dict_type].items():
+        if field not in dat:
+            problems.append('{0} missing'.format(field))
+            continue
+        value = dat[field]
+        if type(value) is not list:
+            problems.append('{0} not list: {1}'.format(field, type(value).__name__))
+            continue
+        if len(keys) == 0:
+            continue
+        for entry in value:
+            if not isinstance(entry, dict):
+                problems.append('{0} entry not dict: {1}'.format(field, type(entry).__name__))
+                break
+            missing = [key for key in keys if key not in entry]
+            if len(missing) > 0:
+                problems.append('{0} entry misses {1}'.format(field, ', '.join(missing)))
+                break
+    return problems
+
+
+class Quarantine(object):
+    """ JSONL file of the units that failed the check - opened when the first unit arrives """
+
+    def __init__(self, filename=None):
+        """
+        :param filename: str, default is quarantine_<pid>.jsonl in the working directory (next to the consumer logs)
+        """
+        self.filename = filename
+        self.file = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, source, problems):
+        """ Write downloaded document to the quarantine file
+
+        :param source: dict, downloaded document ({dict_type: unit}, the _source of the elasticsearch hit)
+        :param problems: list of str, why it is quarantined - stored in the quarantine field of the line
+        """
+        line = dict(source)
+        line['quarantine'] = {'problems': problems, 'time': datetime.datetime.utcnow().isoformat()}
+        with self.lock:
+            if self.file is None:
+                if self.filename is None:
+                    self.filename = 'quarantine_{0}.jsonl'.format(os.getpid())
+                self.file = open(self.filename, 'a')
+            self.file.write(json.dumps(line))
+            self.file.write('\n')
+            self.file.flush()
+            self.count += 1
+        add_error('Quarantined unit {0}: {1}'.format(unit_number(source), '; '.join(problems)))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                print('{0} units quarantined in {1}'.format(self.count, self.filename))
+
+
+def unit_number(source):
+    """ enhedsNummer of downloaded document - None if it has none """
+    for val in source.values():
+        if isinstance(val, dict) and 'enhedsNummer' in val:
+            return val['enhedsNummer']
+    return None
+
+
+def divert(quarantine, source, problems):
+    """ Put downloaded document in quarantine - it is only logged if there is no quarantine
+
+    :param quarantine: Quarantine or None
+    :param source: dict, downloaded document
+    :param problems: list of str, why it is not parsed
+    """
+    if quarantine is not None:
+        quarantine.add(source, problems)
+    else:
+        add_error('Bad unit {0}: {1}'.format(unit_number(source), '; '.join(problems)))
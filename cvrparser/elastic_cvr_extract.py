@@ -1,9 +1,13 @@
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import JSONSerializer
 # import elasticsearch_dsl
-from elasticsearch_dsl import Search
-from collections import namedtuple
+from elasticsearch_dsl import Search, Q
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
 import ujson as json
+import numpy as np
 import os
 import pytz
 import tqdm
@@ -14,36 +18,119 @@ from . import config, create_session, engine, setup_database_connection
 from . import alchemy_tables
 from .bug_report import add_error
 from . import data_scanner
+from . import commit_executor
+from . import document_check
 from .cvr_download import download_all_dicts_to_file
+from .snapshot import read_dump, read_dump_chunk, dump_chunks
+from .frames import encode_frame, decode_frames, page_sources, page_info, page_last_sort, split_page, empty_page
+from .frames import PAGE_SCAN, PAGE_FULL, PAGE_CURSOR
+from .page_size import AdaptivePageSize, search_after_hits
+from .spill_queue import ByteBoundedQueue
+from .samtid_index import SamtidIndex
+from .sql_help import stream_query
 from multiprocessing.pool import Pool
 import multiprocessing
 import time
 import sys
 
 
-def update_all_mp(workers=1):
+def update_all_mp(workers=1, slices=1, delta=False, overlap_hours=24, two_phase=False, resume=False,
+                  use_async=False, route_by_type=False, preload_dimensions=False, dimension_cache_bytes=2**29,
+                  commit_workers=commit_executor.default_workers, write_behind=1):
+    """ Run the producer consumer update
+    With a single producer the scan pages with search_after and the cursor is stored in the database
+    (ScanCursor table) each time all units before it have been committed. With resume the scan continues from there.
+    Each consumer has its own queue and the producers route units to them by enhedsnummer,
+    so the same unit is always handled by the same consumer.
+
+    :param workers: int, number of consumer processes inserting into the database
+    :param slices: int, number of elasticsearch sliced scrolls - each slice gets its own producer process
+    :param delta: bool, only scan units with sidstOpdateret newer than the stored high-water mark (LastUpdated table)
+    :param overlap_hours: int, safety overlap subtracted from the high-water mark in delta mode
+    :param two_phase: bool, first find changed units with a light scan then fetch only those (slices fetchers)
+    :param resume: bool, continue an interrupted scan from the stored cursor
+    :param use_async: bool, run all slices/fetchers as asyncio tasks in one producer process (async_producer.py)
+    :param route_by_type: bool, also route by unit type - each type gets its own consumers (needs workers >= 3)
+    :param preload_dimensions: bool, consumers read the dimension tables into memory at start
+    :param dimension_cache_bytes: int, memory cap of the dimension caches of each consumer
+    :param commit_workers: int, threads writing to the database in each consumer
+    :param write_behind: int, parsed batches each consumer may have waiting to be written
+    """
     # https://docs.python.org/3/howto/logging-cookbook.html
     lock = multiprocessing.Lock()
-    queue_size = 30000
-    queue = multiprocessing.Queue(maxsize=queue_size)  # maxsize=1000*1000*20)
-    prod = multiprocessing.Process(target=cvr_update_producer, args=(queue, lock))
-    # prod.daemon = True
-    prod.start()
-    consumers = [multiprocessing.Process(target=cvr_update_consumer, args=(queue, lock))
-                 for _ in range(workers)]
+    # queue items are raw pages - bounded by bytes, overflow is spilled to disk so the scans never wait on consumers
+    queue_bytes = 2**30
+    queues = [ByteBoundedQueue(max_bytes=queue_bytes // workers) for _ in range(workers)]
+    since = None
+    if delta:
+        since = CvrConnection.get_delta_since(datetime.timedelta(hours=overlap_hours))
+    includes = CvrConnection.get_source_includes()
+    manager = multiprocessing.Manager()
+    newest = manager.dict()
+    changed = None
+    if two_phase:
+        # with delta only the units updated since the high-water mark are compared
+        changed = CvrConnection.get_changed_units(since)
+        if changed is None:
+            print('Empty database - two phase update not useful - running full scan')
+    checkpoint = changed is None and slices == 1 and not use_async
+    scan_type = 'full' if since is None else 'delta'
+    cursor = None
+    if checkpoint and resume:
+        cursor = CvrConnection.get_scan_cursor(scan_type)
+        print('Resuming {0} scan from cursor {1}'.format(scan_type, cursor))
+    elif checkpoint:
+        CvrConnection.clear_scan_cursor(scan_type)
+    elif resume:
+        print('Resume only works for the single producer scan - starting from scratch')
+    ack_queue = None
+    checkpointer = None
+    if checkpoint:
+        ack_queue = multiprocessing.Queue()
+        checkpointer = threading.Thread(target=checkpoint_worker, args=(ack_queue, scan_type, workers))
+        checkpointer.start()
+    if use_async:
+        from .async_producer import cvr_async_producer
+        producers = [multiprocessing.Process(target=cvr_async_producer,
+                                             args=(queues, lock, slices, since, newest, includes, changed,
+                                                   route_by_type))]
+    elif changed is not None:
+        fetch_lists = [changed[fetch_id::slices] for fetch_id in range(slices)]
+        producers = [multiprocessing.Process(target=cvr_id_producer,
+                                             args=(queues, lock, fetch_lists[fetch_id], fetch_id, newest, includes,
+                                                   route_by_type))
+                     for fetch_id in range(slices)]
+    else:
+        producers = [multiprocessing.Process(target=cvr_update_producer,
+                                             args=(queues, lock, slice_id, slices, since, newest, cursor, includes,
+                                                   route_by_type))
+                     for slice_id in range(slices)]
+    for prod in producers:
+        # prod.daemon = True
+        prod.start()
+    samtid_index = None
+    if changed is None:
+        # scan pages are compared with the database versions - load them once (while the producers start)
+        # and share the index read only with the consumers
+        samtid_index = CvrConnection.make_samtid_dict().share()
+    consumers = [multiprocessing.Process(target=cvr_update_consumer,
+                                         args=(queue, lock, newest, ack_queue, samtid_index, preload_dimensions,
+                                               dimension_cache_bytes, commit_workers, write_behind))
+                 for queue in queues]
     for c in consumers:
         c.daemon = True
         c.start()
     try:
-        prod.join()
-        print('Producer done', 'adding sentinels')
+        for prod in producers:
+            prod.join()
+        print('Producers done', 'adding sentinels')
         with lock:
-            print('Producer Done - Adding Sentinels')
+            print('Producers Done - Adding Sentinels')
     except Exception as e:
         with lock:
             print('Something wroing in waiting for producer')
             print('Exception:', e)
-    for i in range(workers):
+    for i, queue in enumerate(queues):
         print('Adding sentinel', i)
         queue.put(CvrConnection.cvr_sentinel)
     
@@ -51,16 +138,141 @@ def update_all_mp(workers=1):
         print('waiting for consumers', c)
         c.join()
     print('all consumers done')
-    queue.close()
+    for queue in queues:
+        queue.close()
+    if checkpointer is not None:
+        ack_queue.put(None)
+        checkpointer.join()
+    if samtid_index is not None:
+        samtid_index.remove()
+    if any(c.exitcode != 0 for c in consumers):
+        # units left in the queue of a dead consumer were never written
+        print('Consumer failed - high-water mark not updated')
+        if checkpoint:
+            print('Restart with update --resume to continue the scan')
+    elif newest.get('failed', False) or any(prod.exitcode != 0 for prod in producers):
+        print('Producer failed - high-water mark not updated')
+        if checkpoint:
+            print('Restart with update --resume to continue the scan')
+    else:
+        CvrConnection.set_last_updated({k: v for (k, v) in newest.items() if k != 'failed'})
+        if checkpoint:
+            CvrConnection.clear_scan_cursor(scan_type)
+    manager.shutdown()
     
 
-def create_elastic_connection(url, authentication, timeout=60, max_retries=10, retry=True):
+class RawSerializer(JSONSerializer):
+    """ Do not decode elasticsearch responses - return the raw json text """
+
+    def loads(self, s):
+        return s
+
+
+def create_elastic_connection(url, authentication, timeout=60, max_retries=10, retry=True, raw=False, maxsize=10):
+    """ Make elasticsearch client
+
+    :param raw: bool, if true responses are returned as raw json strings, not decoded
+    :param maxsize: int, size of the connection pool - requests that can be in flight from threads
+    """
+    serializer = RawSerializer() if raw else JSONSerializer()
     return Elasticsearch(url,
                          http_auth=authentication,
                          timeout=timeout,
                          max_retries=max_retries,
                          retry_on_timeout=retry,
-                         http_compress=True)
+                         http_compress=True,
+                         maxsize=maxsize,
+                         serializer=serializer)
+
+
+def raw_scan(raw_client, index, query, page_size, scroll='5m'):
+    """ Scroll through search results like elasticsearch.helpers.scan
+    but yield each page as the raw json text, which is passed on to the consumers as it is.
+    The page size of a scroll is fixed when it starts, so page_size only logs the throughput.
+
+    :param raw_client: Elasticsearch, made with create_elastic_connection(..., raw=True)
+    :param index: str, index to search
+    :param query: dict, search body
+    :param page_size: AdaptivePageSize, documents per page (per shard)
+    :param scroll: str, scroll keep alive time
+    :return: generator of (str, int) - raw page and number of hits in it
+    """
+    t0 = time.time()
+    page = raw_client.search(index=index, body=query, scroll=scroll, size=page_size.size)
+    scroll_id, hits = page_info(page)
+    page_size.record(hits, len(page), time.time() - t0)
+    try:
+        while hits > 0:
+            yield page, hits
+            t0 = time.time()
+            page = raw_client.scroll(body={'scroll_id': scroll_id, 'scroll': scroll})
+            scroll_id, hits = page_info(page)
+            page_size.record(hits, len(page), time.time() - t0)
+    finally:
+        if scroll_id is not None:
+            raw_client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404,))
+        page_size.summary()
+
+
+def search_after_scan(raw_client, index, query, page_size, cursor=None):
+    """ Page through search results sorted by CvrConnection.scan_sort with search_after.
+    No scroll context is kept on the server, so the scan can not expire and can be restarted from any cursor.
+    Each request can use a new page size, which page_size adapts to the measured throughput.
+
+    :param raw_client: Elasticsearch, made with create_elastic_connection(..., raw=True)
+    :param index: str, index to search
+    :param query: dict, search body
+    :param page_size: AdaptivePageSize, documents per page
+    :param cursor: list, sort values of the last document already seen - None to start from the beginning
+    :return: generator of (str, int, list) - raw page, number of hits in it and its cursor
+    """
+    body = dict(query)
+    body['sort'] = CvrConnection.scan_sort
+    while True:
+        body['size'] = page_size.size
+        if cursor is not None:
+            body['search_after'] = cursor
+        t0 = time.time()
+        page = raw_client.search(index=index, body=body)
+        _, hits = page_info(page)
+        page_size.record(hits, len(page), time.time() - t0)
+        if hits == 0:
+            break
+        cursor = page_last_sort(page)
+        yield page, hits, cursor
+    page_size.summary()
+
+
+def checkpoint_worker(ack_queue, scan_type, parts=1):
+    """ Store scan cursor when pages are committed.
+    Consumers commit pages out of order, the cursor is only moved past pages where all earlier pages are committed too.
+
+    :param ack_queue: multiprocessing.Queue, (seq, cursor) for committed pages, None to stop
+    :param scan_type: str, full or delta
+    :param parts: int, number of consumers each page is split between - all must acknowledge it
+    """
+    done = {}
+    acks = {}
+    next_seq = 0
+    while True:
+        item = ack_queue.get()
+        if item is None:
+            break
+        seq, cursor = item
+        acks[seq] = acks.get(seq, 0) + 1
+        if acks[seq] < parts:
+            continue
+        del acks[seq]
+        done[seq] = cursor
+        cursor = None
+        while next_seq in done:
+            cursor = done.pop(next_seq)
+            next_seq += 1
+        if cursor is not None:
+            try:
+                CvrConnection.set_scan_cursor(scan_type, cursor)
+            except Exception as e:
+                print('Failed to store scan cursor', e)
 
 
 class CvrConnection(object):
@@ -72,6 +284,10 @@ class CvrConnection(object):
     update_info = namedtuple('update_info', ['samtid', 'sidstopdateret'])
     cvr_sentinel = 'CVR_SENTINEL'
     cvr_nothing = 'NOTHING_RETURNED'
+    # deterministic order for search_after - the document _id is the enhedsnummer
+    scan_sort = [{'_id': 'asc'}]
+    # fields read by the update itself (DocumentSorter) - always downloaded
+    sorter_fields = {'enhedsNummer', 'samtId', 'sidstOpdateret'}
 
     def __init__(self, update_address=False):
         """ Setup everything needed for elasticsearch
@@ -94,10 +310,20 @@ class CvrConnection(object):
         self.update_batch_size = 64
         self.update_address = update_address
         self.address_parser_factory = data_scanner.AddressParserFactory()
+        # parser pipelines of each unit type and their dimension caches - kept between batches, see get_data_parser
+        self.data_parsers = {}
+        self.keystore = None
+        # read the dimension tables into memory when the parsers are made
+        self.preload_dimensions = False
+        # memory cap of the large dimension caches (names, contact info)
+        self.dimension_cache_bytes = 2**29
         # self.ElasticParams = [self.url, (self.user, self.password), 60, 10, True]
         self.elastic_client = create_elastic_connection(self.url, (self.user, self.password))
         print('Elastic Search Client:', self.elastic_client.info())
         self.elastic_search_scan_size = 128
+        # bounds of the adaptive page size - pages are also kept below scan_max_page_bytes
+        self.scan_max_page_size = 1024
+        self.scan_max_page_bytes = 2**24
         self.elastic_search_scroll_time = u'20m'
         # max number of updates to download without scan scroll
         self.max_download_size = 200000
@@ -156,16 +382,30 @@ class CvrConnection(object):
         hits = response.hits.hits
         return hits
 
-    @staticmethod
-    def update_all(self, worker_count=3):
+    def update_all(self, resume=False, worker_count=3, slices=1, delta=False, overlap_hours=24, two_phase=False,
+                   use_async=False, route_by_type=False, preload_dimensions=False, dimension_cache_mb=512,
+                   commit_workers=commit_executor.default_workers, write_behind=1):
         """
         Update CVR Company Data
         download updates
         perform updates
 
         rewrite to producer consumer.
+        :param resume: bool, continue interrupted scan from stored cursor
+        :param worker_count: int, number of consumer processes
+        :param slices: int, number of parallel sliced scrolls (producer processes)
+        :param delta: bool, only scan units updated since last run
+        :param overlap_hours: int, hours of safety overlap in delta mode
+        :param two_phase: bool, find changed units first and only download those
+        :param use_async: bool, one asyncio producer process for all slices/fetchers
+        :param route_by_type: bool, give each unit type its own consumers
+        :param preload_dimensions: bool, consumers read the dimension tables (names, brancher...) into memory at start
+        :param dimension_cache_mb: int, memory cap in MB of the dimension caches of each consumer
+        :param commit_workers: int, threads writing to the database in each consumer
+        :param write_behind: int, parsed batches each consumer may have waiting to be written - 0 to disable
         """
-        update_all_mp(worker_count)
+        update_all_mp(worker_count, slices, delta, overlap_hours, two_phase, resume, use_async, route_by_type,
+                      preload_dimensions, dimension_cache_mb * 2**20, commit_workers, write_behind)
         return
         # assert False, 'DEPRECATED'
         # session = create_session()
@@ -177,6 +417,122 @@ class CvrConnection(object):
         # else:
         #     update_since_last(3)
 
+    @staticmethod
+    def get_last_updated():
+        """ Get the stored sidstOpdateret high-water mark for each unit type
+
+        :return: dict, unit type (Vrvirksomhed, ...) -> utc datetime
+        """
+        table = alchemy_tables.Lastupdated
+        session = create_session()
+        query = session.query(table.updatetype, table.lastupdated)
+        res = {x[0]: x[1].replace(tzinfo=pytz.utc) for x in query.all()}
+        session.close()
+        return res
+
+    @staticmethod
+    def set_last_updated(newest):
+        """ Store sidstOpdateret high-water marks - only move them forward
+
+        :param newest: dict, unit type -> utc datetime
+        """
+        if len(newest) == 0:
+            return
+        current = CvrConnection.get_last_updated()
+        session = create_session()
+        for _type, last in newest.items():
+            if _type in current and current[_type] >= last:
+                continue
+            naive_last = last.astimezone(pytz.utc).replace(tzinfo=None)
+            session.merge(alchemy_tables.Lastupdated(updatetype=_type, lastupdated=naive_last))
+            print('High-water mark {0}: {1}'.format(_type, last))
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def get_source_includes():
+        """ Make _source includes for downloads from the fields the parsers read,
+        so fields nobody uses are not transferred and decoded
+
+        :return: list of str, e.g. Vrvirksomhed.navne - None if some parser does not declare its fields
+        """
+        address_fields = data_scanner.AddressParser().adresse_parser.source_fields()
+        includes = []
+        for _type in sorted(CvrConnection.source_keymap.values()):
+            fields = data_scanner.DataParser(_type=_type).source_fields()
+            if fields is None or address_fields is None:
+                add_error('Parser fields unknown for {0} - downloading complete documents'.format(_type))
+                return None
+            fields = fields | address_fields | CvrConnection.sorter_fields
+            includes.extend('{0}.{1}'.format(_type, x) for x in sorted(fields))
+        return includes
+
+    @staticmethod
+    def get_scan_cursor(scan_type):
+        """ Get stored cursor of interrupted scan
+
+        :param scan_type: str, full or delta
+        :return: list, search_after sort values or None
+        """
+        session = create_session()
+        res = session.query(alchemy_tables.Scancursor.cursor).filter(
+            alchemy_tables.Scancursor.scantype == scan_type).first()
+        session.close()
+        if res is None:
+            return None
+        return json.loads(res[0])
+
+    @staticmethod
+    def set_scan_cursor(scan_type, cursor):
+        """ Store cursor of scan - everything up to and including it is committed
+
+        :param scan_type: str, full or delta
+        :param cursor: list, search_after sort values
+        """
+        session = create_session()
+        session.merge(alchemy_tables.Scancursor(scantype=scan_type, cursor=json.dumps(cursor),
+                                                updated=datetime.datetime.utcnow()))
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def clear_scan_cursor(scan_type):
+        """ Remove stored cursor - the scan is done
+
+        :param scan_type: str, full or delta
+        """
+        session = create_session()
+        session.query(alchemy_tables.Scancursor).filter(alchemy_tables.Scancursor.scantype == scan_type).delete()
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def get_delta_since(overlap):
+        """ Get the sidstOpdateret to scan from for each unit type in delta mode
+
+        :param overlap: datetime.timedelta, safety overlap subtracted from the high-water marks
+        :return: dict, unit type -> utc datetime or None if some type has never been fully updated
+        """
+        last_updated = CvrConnection.get_last_updated()
+        missing = set(CvrConnection.source_keymap.values()) - last_updated.keys()
+        if len(missing) > 0:
+            print('No high-water mark for {0} - running full scan'.format(', '.join(sorted(missing))))
+            return None
+        since = {k: v - overlap for (k, v) in last_updated.items() if k in CvrConnection.source_keymap.values()}
+        print('Delta update since: {0}'.format(since))
+        return since
+
+    @staticmethod
+    def make_delta_query(since):
+        """ Query for units with sidstOpdateret newer than since
+
+        :param since: dict, unit type -> utc datetime
+        :return: elasticsearch_dsl.Q
+        """
+        ranges = [Q('range', **{'{0}.sidstOpdateret'.format(_type): {'gte': since[_type].isoformat()}})
+                  for _type in CvrConnection.source_keymap.values()]
+        return Q('bool', should=ranges, minimum_should_match=1)
+
     def download_all_data_to_file(self, filename):
         """
         :return:
@@ -221,6 +577,47 @@ class CvrConnection(object):
             print('{0} handled:'.format(_type))
         return filename
 
+    def fetch_units(self, enh, batch_size=256, includes=None):
+        """ Download the given units in batches of ids queries
+
+        :param enh: list, id of units to download (enhedsnummer)
+        :param batch_size: int, number of units in each request
+        :param includes: list, _source includes (see get_source_includes) - None for the complete documents
+        :return: generator of dicts, the _source of each unit
+        """
+        for i in range(0, len(enh), batch_size):
+            batch = enh[i:i+batch_size]
+            body = {'query': {'ids': {'values': batch}}, 'size': len(batch)}
+            if includes is not None:
+                body['_source'] = includes
+            response = self.elastic_client.search(index=self.index, body=body)
+            for hit in response['hits']['hits']:
+                yield hit['_source']
+
+    def fetch_unit_pages(self, enh, page_size=None, includes=None):
+        """ Download the given units in batches of ids queries without decoding them
+
+        :param enh: list, id of units to download (enhedsnummer)
+        :param page_size: AdaptivePageSize, number of units in each request - None for default
+        :param includes: list, _source includes (see get_source_includes) - None for the complete documents
+        :return: generator of (str, int), raw json page and number of units requested
+        """
+        if page_size is None:
+            page_size = AdaptivePageSize(size=256, max_size=2048, name='fetch')
+        raw_client = create_elastic_connection(self.url, (self.user, self.password), raw=True)
+        i = 0
+        while i < len(enh):
+            batch = enh[i:i+page_size.size]
+            i += len(batch)
+            body = {'query': {'ids': {'values': batch}}, 'size': len(batch)}
+            if includes is not None:
+                body['_source'] = includes
+            t0 = time.time()
+            page = raw_client.search(index=self.index, body=body)
+            page_size.record(len(batch), len(page), time.time() - t0)
+            yield page, len(batch)
+        page_size.summary()
+
     def update_units(self, enh):
         """ Force download and update of given units
 
@@ -228,37 +625,15 @@ class CvrConnection(object):
         -----
           enh: list , id of units to update (enhedsnummer)
         """
-        data_list = self.get_entity(enh)
         dicts = {x: list() for x in self.source_keymap.values()}
-        for _data_dict in data_list:
-            # dict_type = data_dict['_type']
-            # print('data dict', data_dict)
-            #dict_type = data_dict['_type']
-            try:
-                data_dict = _data_dict.to_dict()
-            except Exception as e:
-                data_dict = _data_dict
-            
-            keys = data_dict['_source'].keys()
+        for source in self.fetch_units(enh, includes=CvrConnection.get_source_includes()):
+            keys = source.keys()
             dict_type_set = keys & CvrConnection.source_keymap.values()  # intersects the two key sets
             if len(dict_type_set) != 1:
-                #import pdb
-                #pdb.set_trace()
-                add_error('BAD DICT DOWNLOADED {0} - {1}'.format(data_dict, _data_dict))
+                add_error('BAD DICT DOWNLOADED {0}'.format(source))
                 continue
             key = dict_type_set.pop()
-            # if dict_type not in self.source_keymap:
-            #     dict_type = data_dict['_source'].keys()
-            #     import pdb
-            #     pdb.set_trace()
-            #     if data_dict['_source']['enhedsType'] == 'VIRKSOMHED':
-            #         dicts['Vrvirksomhed'].append(data_dict['_source'])
-            #     else:
-            #         import pdb
-            #         pdb.set_trace()
-            #         assert False
-            # key = self.source_keymap[dict_type]
-            dicts[key].append(data_dict['_source'][key])
+            dicts[key].append(source[key])
             if len(dicts[key]) >= self.update_batch_size:
                 self.update(dicts[key], key)
                 dicts[key].clear()
@@ -331,12 +706,10 @@ class CvrConnection(object):
             print('bad _type: ', _type)
             raise Exception('bad _type')
         delete_table_models.append(static_table)
-        #  delete independently from several tables. Lets thread them
-        # maybe threadpool is faster...
+        #  delete independently from several tables on the commit executor
 
-        def worker(work_idx):
+        def worker(table_class):
             session = create_session()
-            table_class = delete_table_models[work_idx]
             session.query(table_class).filter(table_class.enhedsnummer.in_(enh)).delete(synchronize_session=False)
             session.commit()
             session.close()
@@ -349,18 +722,10 @@ class CvrConnection(object):
             session.commit()
             session.close()
 
-        threads = []
+        tasks = [(table_class, functools.partial(worker, table_class)) for table_class in delete_table_models]
         if _type == 'Vrvirksomhed':
-            t = threading.Thread(target=enh_worker)
-            threads.append(t)
-            t.start()
-        for i in range(len(delete_table_models)):
-            t = threading.Thread(target=worker, args=(i,))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
+            tasks.append((alchemy_tables.Enhedsrelation, enh_worker))
+        commit_executor.run(tasks)
 
     @staticmethod
     def delete_employment_only(enh):
@@ -373,22 +738,40 @@ class CvrConnection(object):
                                alchemy_tables.erstMaanedsbeskaeftigelse
                               ]
 
-        def worker(work_idx):
+        def worker(table_class):
             session = create_session()
-            table_class = delete_table_models[work_idx]
             session.query(table_class).filter(table_class.enhedsnummer.in_(enh)).delete(synchronize_session=False)
             session.commit()
             session.close()
-        
-        threads = []
-        for i in range(len(delete_table_models)):
-            t = threading.Thread(target=worker, args=(i,))
-            threads.append(t)
-            t.start()
-    
-        for t in threads:
-            t.join()
+
+        commit_executor.run([(table_class, functools.partial(worker, table_class))
+                             for table_class in delete_table_models])
           
+    def get_data_parser(self, enh_type):
+        """ Data parser of unit type - made once and reused for all batches so its key store stays warm
+
+        :param enh_type: cvr object type
+        :return: data_scanner.DataParser
+        """
+        if enh_type not in self.data_parsers:
+            self.data_parsers[enh_type] = data_scanner.DataParser(_type=enh_type, keystore=self.get_keystore())
+        return self.data_parsers[enh_type]
+
+    def get_keystore(self):
+        """ Dimension caches shared by the parsers of all unit types
+
+        :return: data_scanner.KeyStore
+        """
+        if self.keystore is None:
+            self.keystore = data_scanner.KeyStore(preload=self.preload_dimensions,
+                                                  max_bytes=self.dimension_cache_bytes)
+        return self.keystore
+
+    def reset_data_parsers(self):
+        """ Drop the parsers and the key store - they may hold rows and unmapped keys of a failed batch """
+        self.data_parsers = {}
+        self.keystore = None
+
     def insert(self, dicts, enh_type):
         """ Insert data from dicts
 
@@ -396,23 +779,47 @@ class CvrConnection(object):
         :param dicts: list of dicts with cvr data (Danish Business Authority)
         :param enh_type: cvr object type
         """
-        data_parser = data_scanner.DataParser(_type=enh_type)
+        data_parser = self.get_data_parser(enh_type)
         address_parser = self.address_parser_factory.create_parser(self.update_address)
-        #print('parse data')
-        data_parser.parse_data(dicts)
-        #print('parse dynamic data')
-        data_parser.parse_dynamic_data(dicts)
-        #print('parse address')
-        address_parser.parse_address_data(dicts)
-        # print('address data inserted/skipped - start static')
-        #print('parse static data')
-        data_parser.parse_static_data(dicts)
-        # print('static parsed')
+        try:
+            # one pass over the documents for data, dynamic, address and static parsers
+            data_parser.parse(dicts, [address_parser.adresse_parser])
+        except Exception:
+            # start over with new parsers
+            self.reset_data_parsers()
+            raise
+
+    def parse_batch(self, dicts, data_parser):
+        """ Parsing half of update - the rows are kept in the parsers until write_batch (see WriteBehind)
+
+        :param dicts: list of dicts with cvr data
+        :param data_parser: data_scanner.DataParser of the unit type, not used by other batches until written
+        :return: list of parsers holding the rows
+        """
+        address_parser = self.address_parser_factory.create_parser(self.update_address)
+        return data_parser.parse_rows(dicts, [address_parser.adresse_parser])
+
+    @staticmethod
+    def write_batch(dicts, enh_type, data_parser, parsers):
+        """ Writing half of update - delete the units and insert the rows parsed by parse_batch
+
+        :param dicts: list of dicts with cvr data
+        :param enh_type: cvr object type
+        :param data_parser: data_scanner.DataParser used by parse_batch
+        :param parsers: list of parsers returned by parse_batch
+        """
+        enh = [x['enhedsNummer'] for x in dicts]
+        CvrConnection.delete(enh, enh_type)
+        data_parser.write_rows(parsers)
 
     def insert_employment_only(self, dicts, enh_type):
         """ Inserts only employment data - needed to to missing version id when employment data updated in CVR"""
-        data_parser = data_scanner.DataParser(_type=enh_type)
-        data_parser.parse_employment(dicts)
+        data_parser = self.get_data_parser(enh_type)
+        try:
+            data_parser.parse_employment(dicts)
+        except Exception:
+            self.reset_data_parsers()
+            raise
     
     @staticmethod
     def get_samtid_dict(table):
@@ -420,25 +827,42 @@ class CvrConnection(object):
         query = session.query(table.enhedsnummer,
                               table.samtid,
                               table.sidstopdateret)
-        existing_data = [(x[0], x[1], x[2]) for x in query.all()]
-        tmp = {a: CvrConnection.update_info(samtid=b, sidstopdateret=c) for (a, b, c) in existing_data}
+        tmp = {a: CvrConnection.update_info(samtid=b, sidstopdateret=c)
+               for chunk in stream_query(query) for (a, b, c) in chunk}
         session.close()
         return tmp
 
+    @staticmethod
+    def get_samtid_index(table):
+        """ Index of the versions of the units in table.
+        The rows are streamed from the database in chunks straight into the arrays of the index.
+
+        :param table: alchemy table model (Virksomhed, Produktion or Person)
+        :return: SamtidIndex
+        """
+        session = create_session()
+        query = session.query(table.enhedsnummer,
+                              table.samtid,
+                              table.sidstopdateret)
+        index = SamtidIndex.from_row_chunks(stream_query(query))
+        session.close()
+        return index
+
     @staticmethod
     def make_samtid_dict():
-        """ Make mapping from entity id to current version
+        """ Make mapping from entity id to current version - a compact SamtidIndex (sorted numpy arrays)
+        that supports the dict lookups of the old map. Use SamtidIndex.share to pass it to other processes.
         Add threading to run in parallel to see if that increase speed. Use threadpool instad of concurrent_future
+
+        :return: SamtidIndex
         """
         logger = logging.getLogger('cvrparser')
         logger.info('Make id -> samtId map: units update status map')
         table_models = [alchemy_tables.Virksomhed, alchemy_tables.Produktion, alchemy_tables.Person]
-        enh_samtid_map = {}
+        indexes = [None] * len(table_models)
 
         def worker(table_idx):
-            table = table_models[table_idx]
-            tmp = CvrConnection.get_samtid_dict(table)
-            enh_samtid_map.update(tmp)
+            indexes[table_idx] = CvrConnection.get_samtid_index(table_models[table_idx])
 
         threads = []
         for i in range(len(table_models)):
@@ -447,51 +871,78 @@ class CvrConnection(object):
             t.start()
         for t in threads:
             t.join()
-
-        logger.info('Id map done')
+        enh_samtid_map = SamtidIndex.concatenate(indexes)
+        logger.info('Id map done - {0} units'.format(len(enh_samtid_map)))
         return enh_samtid_map
 
-    def update_from_mixed_file(self, filename, force=False):
+    def update_from_mixed_file(self, filename, force=False, workers=1):
         """ splits data in file by type and updates the database
+        With more than one worker the file is split in chunks (snapshot frames or line aligned byte ranges)
+        that are replayed in parallel by a process pool, see replay_file_mp.
 
-        :param filename: str, filename full path
+        :param filename: str, filename full path - snapshot (.snap) or JSONL file
         :param force: bool, force to update all
+        :param workers: int, number of processes replaying the file
         :return:
         """
         print('Start Reading From File', filename)
         if force:
-            enh_samtid_map = {}
+            enh_samtid_map = SamtidIndex.from_rows([])
         else:
             enh_samtid_map = self.make_samtid_dict()
-        dummy = CvrConnection.update_info(samtid=-1, sidstopdateret=self.dummy_date)
+        if workers > 1:
+            replay_file_mp(filename, enh_samtid_map, workers, self.update_address, self.preload_dimensions,
+                           self.dimension_cache_bytes, commit_executor.commit_executor.workers)
+        else:
+            quarantine = document_check.Quarantine()
+            self.replay_sources(tqdm.tqdm(read_dump(filename)), enh_samtid_map, quarantine)
+            quarantine.close()
+        print('file read all updated')
+
+    def replay_sources(self, sources, enh_samtid_map, quarantine=None):
+        """ Update the downloaded units that are newer than the database version, in batches of update_batch_size
+
+        :param sources: iterable of dicts, downloaded documents (_source of elasticsearch hits)
+        :param enh_samtid_map: SamtidIndex, versions of the units in the database
+        :param quarantine: document_check.Quarantine, units the parsers cannot handle go here - None to only log them
+        :return: int, number of units updated
+        """
         dicts = {x: list() for x in self.source_keymap.values()}
-        with open(filename) as f:
-            for line in tqdm.tqdm(f):
-                raw_dat = json.loads(line)
-                keys = raw_dat.keys()
-                dict_type_set = keys & self.source_keymap.values()  # intersects the two key sets
-                if len(dict_type_set) != 1:
-                    add_error('BAD DICT DOWNLOADED {0}'.format(str(raw_dat)))
-                    continue
-                dict_type = dict_type_set.pop()
-                dat = raw_dat[dict_type]
+        updated = 0
+        for raw_dat in sources:
+            keys = raw_dat.keys()
+            dict_type_set = keys & self.source_keymap.values()  # intersects the two key sets
+            if len(dict_type_set) != 1:
+                add_error('BAD DICT DOWNLOADED {0}'.format(str(raw_dat)))
+                continue
+            dict_type = dict_type_set.pop()
+            dat = raw_dat[dict_type]
+            try:
                 enhedsnummer = dat['enhedsNummer']
                 samtid = dat['samtId']
-                if dat['samtId'] is None:
-                    add_error('Samtid none. '.format(enhedsnummer))
-                    dat['samtId'] = -1
-                    samtid = -1
-                current_update = enh_samtid_map[enhedsnummer] if enhedsnummer in enh_samtid_map else dummy
-                if samtid > current_update.samtid:
-                    # update if new version - currently or sidstopdateret > current_update.sidstopdateret:
-                    dicts[dict_type].append(dat)
-                if len(dicts[dict_type]) >= self.update_batch_size:
-                    self.update(dicts[dict_type], dict_type)
-                    dicts[dict_type].clear()
+            except KeyError as e:
+                document_check.divert(quarantine, raw_dat, ['{0} missing'.format(e)])
+                continue
+            if dat['samtId'] is None:
+                add_error('Samtid none. '.format(enhedsnummer))
+                dat['samtId'] = -1
+                samtid = -1
+            if samtid > enh_samtid_map.get_samtid(enhedsnummer):
+                # update if new version - currently or sidstopdateret > current_update.sidstopdateret:
+                problems = document_check.check_unit(dict_type, dat)
+                if len(problems) > 0:
+                    document_check.divert(quarantine, raw_dat, problems)
+                    continue
+                dicts[dict_type].append(dat)
+            if len(dicts[dict_type]) >= self.update_batch_size:
+                self.update(dicts[dict_type], dict_type)
+                updated += len(dicts[dict_type])
+                dicts[dict_type].clear()
         for enh_type, _dicts in dicts.items():
             if len(_dicts) > 0:
                 self.update(_dicts, enh_type)
-        print('file read all updated')
+                updated += len(_dicts)
+        return updated
 
     def get_update_list_single_process(self):
         """ Find units that needs updating and their sidstopdateret (last updated)
@@ -506,7 +957,6 @@ class CvrConnection(object):
         update_dicts = {x: {'units': [], 'sidstopdateret': oldest_sidstopdateret} for x in self.source_keymap.values()}
         if len(enh_samtid_map) == 0:
             return update_dicts
-        dummy = CvrConnection.update_info(samtid=-1, sidstopdateret=self.dummy_date)
         print('Get update time for all data')
 
         for _type in self.source_keymap.values():
@@ -529,8 +979,7 @@ class CvrConnection(object):
                 sidstopdateret = raw_dat[sidst_key][0] if sidst_key in raw_dat else None
                 if sidstopdateret is None or samtid is None:
                     continue
-                current_update = enh_samtid_map[enhedsnummer] if enhedsnummer in enh_samtid_map else dummy
-                if samtid > current_update.samtid:
+                if samtid > enh_samtid_map.get_samtid(enhedsnummer):
                     utc_sidstopdateret = utc_transform(sidstopdateret)
                     update_dicts[_type]['sidstopdateret'] = min(utc_sidstopdateret,
                                                                 update_dicts[_type]['sidstopdateret'])
@@ -543,16 +992,47 @@ class CvrConnection(object):
     def get_update_list_type(self, _type):
         return update_time_worker((_type, self.url, self.user, self.password, self.index))
 
-    def get_update_list(self):
+    def get_update_list(self, since=None):
         """ Threaded version - may not be so IO wait bound since we stream
-        so maybe change to process pool instead """
+        so maybe change to process pool instead
+        The samtId index is loaded once and shared (memory mapped) with the workers
+
+        :param since: dict, unit type -> utc datetime, only scan units updated since then - None to scan all
+        """
+        samtid_index = self.make_samtid_dict().share()
         pool = Pool(processes=3)
-        result = pool.map(update_time_worker, [(x, self.url, self.user, self.password, self.index)
-                                               for x in self.source_keymap.values()], chunksize=1)
+        try:
+            result = pool.map(update_time_worker, [(x, self.url, self.user, self.password, self.index, samtid_index,
+                                                    None if since is None else since[x])
+                                                   for x in self.source_keymap.values()], chunksize=1)
+        finally:
+            pool.close()
+            samtid_index.remove()
         update_dicts = {x: y for (x, y) in result}
         print([(k, v['sidstopdateret'], len(v['units'])) for k, v in update_dicts.items()])
         return update_dicts
 
+    @staticmethod
+    def get_changed_units(since=None):
+        """ Phase one of two phase update: find the units with a newer samtId than in the database
+        by scanning only _id, samtId and sidstOpdateret.
+        Employment only changes (same samtId) are not found this way.
+
+        :param since: dict, unit type -> utc datetime, only scan units updated since then (delta) - None to scan all
+        :return: list of enhedsnummer to download, None if database is empty
+        """
+        session = create_session()
+        empty = all(session.query(table.enhedsnummer).first() is None
+                    for table in [alchemy_tables.Virksomhed, alchemy_tables.Produktion, alchemy_tables.Person])
+        session.close()
+        if empty:
+            return None
+        cvr = CvrConnection()
+        update_info = cvr.get_update_list(since)
+        changed = sorted(set(x[0] for info in update_info.values() for x in info['units']))
+        print('Changed units to download: {0}'.format(len(changed)))
+        return changed
+
     def optimize_download_updated(self, update_info):
         """ DEPRECATED
 
@@ -598,44 +1078,144 @@ class CvrConnection(object):
         return ids
 
 
+# hits of the samtId scan compared with the index at a time
+update_time_chunk = 2**16
+
+
 def update_time_worker(args):
     _type = args[0]
     url = args[1]
     user = args[2]
     password = args[3]
     index = args[4]
-    enh_samtid_map = CvrConnection.make_samtid_dict()
-    dummy_date = datetime.datetime(year=1001, month=1, day=1, tzinfo=pytz.utc)
-    dummy = CvrConnection.update_info(samtid=-1, sidstopdateret=dummy_date)
+    # shared index from get_update_list - otherwise load it here
+    enh_samtid_map = args[5] if len(args) > 5 else CvrConnection.make_samtid_dict()
+    # delta window of the type - None to scan all units
+    since = args[6] if len(args) > 6 else None
     oldest_sidstopdateret = datetime.datetime.utcnow().replace(tzinfo=pytz.utc) + datetime.timedelta(days=1)
     type_dict = {'units': [], 'sidstopdateret': oldest_sidstopdateret}
     if len(enh_samtid_map) == 0:
-        return type_dict
+        return _type, type_dict
     elastic_client = create_elastic_connection(url, (user, password))
-    search = Search(using=elastic_client, index=index).query('match_all')
     sidst_key = '{0}.sidstOpdateret'.format(_type)
     samt_key = '{0}.samtId'.format(_type)
-    field_list = ['_id', sidst_key, samt_key]
-    search = search.fields(fields=field_list)
-    params = {'scroll': '10m', 'size': 2 ** 12}
-    search = search.params(**params)
+    # only documents of this type and only the two fields needed
+    search = Search(using=elastic_client, index=index).query('exists', field=samt_key)
+    if since is not None:
+        search = search.query(Q('range', **{sidst_key: {'gte': since.isoformat()}}))
+    search = search.source([sidst_key, samt_key])
     print('ElasticSearch Query: ', search.to_dict())
-    generator = search.scan()
+    page_size = AdaptivePageSize(size=2 ** 12, max_size=2 ** 13, name='samtId scan {0}'.format(_type))
+    generator = search_after_hits(elastic_client, index, search.to_dict(), CvrConnection.scan_sort, page_size)
+    enh = []
+    samtids = []
+    sidst = []
+
+    def compare_chunk():
+        # compare the downloaded versions with the index in one vectorized lookup - only changed units are kept
+        for i in np.flatnonzero(enh_samtid_map.newer(enh, samtids)):
+            utc_sidstopdateret = utc_transform(sidst[i])
+            type_dict['sidstopdateret'] = min(utc_sidstopdateret, type_dict['sidstopdateret'])
+            type_dict['units'].append((enh[i], utc_sidstopdateret))
+        enh.clear()
+        samtids.clear()
+        sidst.clear()
+
     for cvr_update in generator:
-        enhedsnummer = int(cvr_update.meta.id)
-        raw_dat = cvr_update.to_dict()
-        samtid = raw_dat[samt_key][0] if samt_key in raw_dat else None
-        sidstopdateret = raw_dat[sidst_key][0] if sidst_key in raw_dat else None
+        raw_dat = cvr_update['_source'].get(_type, {})
+        samtid = raw_dat.get('samtId', None)
+        sidstopdateret = raw_dat.get('sidstOpdateret', None)
         if sidstopdateret is None or samtid is None:
             continue
-        current_update = enh_samtid_map[enhedsnummer] if enhedsnummer in enh_samtid_map else dummy
-        if samtid > current_update.samtid:
-            utc_sidstopdateret = utc_transform(sidstopdateret)
-            type_dict['sidstopdateret'] = min(utc_sidstopdateret, type_dict['sidstopdateret'])
-            type_dict['units'].append((enhedsnummer, utc_sidstopdateret))
+        enh.append(int(cvr_update['_id']))
+        samtids.append(samtid)
+        sidst.append(sidstopdateret)
+        if len(enh) >= update_time_chunk:
+            compare_chunk()
+    compare_chunk()
     return _type, type_dict
 
 
+# state of the replay pool workers - set by replay_worker_init
+replay_state = {}
+
+
+def replay_worker_init(filename, enh_samtid_map, update_address, preload_dimensions=False,
+                       dimension_cache_bytes=2**29, commit_workers=commit_executor.default_workers):
+    """ Setup replay pool worker - own database connections and CvrConnection
+
+    :param filename: str, snapshot or JSONL file replayed
+    :param enh_samtid_map: SamtidIndex, versions of the units in the database
+    :param update_address: bool, parse addresses too
+    :param preload_dimensions: bool, read the dimension tables into memory at start
+    :param dimension_cache_bytes: int, memory cap of the dimension caches
+    :param commit_workers: int, threads writing to the database
+    """
+    if not engine.is_none():
+        engine.dispose()
+    else:
+        setup_database_connection()
+    commit_executor.configure(commit_workers)
+    replay_state['filename'] = filename
+    replay_state['enh_samtid_map'] = enh_samtid_map
+    cvr = CvrConnection(update_address=update_address)
+    cvr.preload_dimensions = preload_dimensions
+    cvr.dimension_cache_bytes = dimension_cache_bytes
+    replay_state['cvr'] = cvr
+    replay_state['quarantine'] = document_check.Quarantine()
+
+
+def replay_chunk(chunk):
+    """ Replay one chunk of the file in a pool worker
+
+    :param chunk: (int, int), chunk from snapshot.dump_chunks
+    :return: int, number of units updated
+    """
+    cvr = replay_state['cvr']
+    sources = read_dump_chunk(replay_state['filename'], chunk)
+    try:
+        return cvr.replay_sources(sources, replay_state['enh_samtid_map'], replay_state['quarantine'])
+    except Exception as e:
+        add_error('Replay of chunk {0} of {1} failed: {2}'.format(chunk, replay_state['filename'], e))
+        raise
+
+
+def replay_file_mp(filename, enh_samtid_map, workers, update_address=False, preload_dimensions=False,
+                   dimension_cache_bytes=2**29, commit_workers=commit_executor.default_workers):
+    """ Replay a downloaded snapshot or JSONL file with a process pool.
+    Chunks are snapshot frames or line aligned byte ranges of JSONL files, each chunk is read, filtered on samtId
+    and inserted in batches by one worker. A unit is only in the file once, so the chunks are independent.
+
+    :param filename: str, snapshot (.snap) or JSONL file
+    :param enh_samtid_map: SamtidIndex, versions of the units in the database (empty to update all)
+    :param workers: int, number of worker processes
+    :param update_address: bool, parse addresses too
+    :param preload_dimensions: bool, workers read the dimension tables into memory at start
+    :param dimension_cache_bytes: int, memory cap of the dimension caches of each worker
+    :param commit_workers: int, threads writing to the database in each worker
+    """
+    # a few chunks per worker for JSONL files so the work is spread evenly - snapshots are split by frame
+    chunk_bytes = max(2**20, min(2**26, os.path.getsize(filename) // (4 * workers)))
+    chunks = dump_chunks(filename, chunk_bytes)
+    print('Replaying {0} chunks of {1} with {2} workers'.format(len(chunks), filename, workers))
+    enh_samtid_map = enh_samtid_map.share()
+    pool = Pool(processes=workers, initializer=replay_worker_init,
+                initargs=(filename, enh_samtid_map, update_address, preload_dimensions, dimension_cache_bytes,
+                          commit_workers))
+    updated = 0
+    try:
+        for count in tqdm.tqdm(pool.imap_unordered(replay_chunk, chunks), total=len(chunks)):
+            updated += count
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+        enh_samtid_map.remove()
+    print('Replay done - {0} units updated'.format(updated))
+
+
 def retry_generator(g):
     failed = 0
     while True:
@@ -651,18 +1231,11 @@ def retry_generator(g):
                 raise
 
 
-def cvr_update_producer(queue, lock):
-    """ Producer function that places data to be inserted on the Queue
-
-    :param queue: multiprocessing.Queue
-    :param lock: multiprocessing.Lock
-    """
-    t0 = time.time()
-
-    logger = logging.getLogger('producer')
+def producer_logger(name):
+    logger = logging.getLogger(name)
     logger.setLevel(logging.DEBUG)
     # create file handler which logs even debug messages
-    fh = logging.FileHandler('producer.log')
+    fh = logging.FileHandler('{0}.log'.format(name))
     fh.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
@@ -673,72 +1246,168 @@ def cvr_update_producer(queue, lock):
     # add the handlers to logger
     logger.addHandler(ch)
     logger.addHandler(fh)
-    with lock:
-        logger.info('Starting producer => {}'.format(os.getpid()))
+    return logger
 
-    if not engine.is_none():
-        engine.dispose()        
+
+class DocumentSorter(object):
+    """ Sorts downloaded cvr documents for the consumer.
+    Finds the unit type, decides between full and employment only update
+    and keeps track of the newest sidstOpdateret seen for each unit type.
+    """
+
+    def __init__(self, enh_samtid_map=None):
+        """
+        :param enh_samtid_map: SamtidIndex, versions of units in the database - loaded on first use if None
+        """
+        self.enh_samtid_map = enh_samtid_map
+        self.newest = {}
+
+    def sort(self, source, full_update=None):
+        """ Find type of unit in _source of a downloaded document and if it needs updating
+
+        :param source: dict, _source of elasticsearch hit
+        :param full_update: bool, force full update (True) - None compare samtId with database
+        :return: tuple (dict_type, dat, full_update) or None if no update is needed
+        """
+        keys = source.keys()
+        dict_type_set = keys & CvrConnection.source_keymap.values()  # intersects the two key sets
+        if len(dict_type_set) != 1:
+            add_error('BAD DICT DOWNLOADED CVR UPDATE \n{0} {1}'.format(source, dict_type_set))
+            return None
+        dict_type = dict_type_set.pop()
+        dat = source[dict_type]
+        enhedsnummer = dat['enhedsNummer']
+        samtid = dat['samtId']
+        if dat['samtId'] is None:
+            add_error('Samtid none: enh {0}'.format(enhedsnummer))
+            dat['samtId'] = -1
+            samtid = -1
+        if dat.get('sidstOpdateret', None) is not None:
+            sidstopdateret = utc_transform(dat['sidstOpdateret'])
+            if dict_type not in self.newest or sidstopdateret > self.newest[dict_type]:
+                self.newest[dict_type] = sidstopdateret
+        if full_update is None:
+            if self.enh_samtid_map is None:
+                self.enh_samtid_map = CvrConnection.make_samtid_dict()
+            if samtid > self.enh_samtid_map.get_samtid(enhedsnummer):
+                full_update = True
+            else:
+                if dict_type == 'Vrdeltagerperson':
+                    return None
+                full_update = False
+        return dict_type, dat, full_update
+
+    def store_newest(self, newest):
+        """ Merge newest sidstOpdateret seen into shared dict
+
+        :param newest: dict like (multiprocessing.Manager)
+        """
+        if newest is None:
+            return
+        for _type, sidstopdateret in self.newest.items():
+            if _type not in newest or sidstopdateret > newest[_type]:
+                newest[_type] = sidstopdateret
+
+
+def put_page(queues, kind, page, logger, cursor=None, by_type=False):
+    """ Put raw page on the consumer queues.
+    With several consumers the page is split by enhedsnummer (see frames.split_page) so each unit
+    always goes to the same consumer.
+
+    :param queues: list of queues, one for each consumer
+    :param kind: int, frame kind (PAGE_SCAN or PAGE_FULL)
+    :param page: str, raw json response
+    :param logger: logging.Logger
+    :param cursor: list, [seq, cursor] of a checkpointed page - all consumers get their part, also if it is empty,
+    so they all acknowledge the page
+    :param by_type: bool, also route by unit type
+    """
+    if len(queues) == 1:
+        parts = [page]
     else:
-        setup_database_connection()
-        with lock:
-            logger.info('setup databaseconnection - lost in spawn/fork')    
+        parts = split_page(page, len(queues), by_type)
+    for queue, part in zip(queues, parts):
+        if cursor is None and part == empty_page:
+            continue
+        frame = encode_frame(kind, part)
+        if cursor is not None:
+            frame = encode_frame(PAGE_CURSOR, json.dumps(cursor)) + frame
+        put_frame(queue, frame, logger)
+
+
+def put_frame(queue, frame, logger):
+    """ Put frame on queue - retry on timeouts """
+    for repeat in range(20):
+        try:
+            queue.put(frame, timeout=60)
+            break
+        except Exception as e:
+            logger.debug('Producer timeout failed {0} - retrying - repeat: {1} - queue full {2} (unreliable)'.format(str(e), repeat, queue.full()))
+            if repeat > 10:
+                raise(e)
+
+
+def cvr_update_producer(queues, lock, slice_id=0, slices=1, since=None, newest=None, cursor=None, includes=None,
+                        by_type=False):
+    """ Producer function that places data to be inserted on the Queue
+    The producer does not decode the documents - it passes the raw pages on to the consumers
+    that decode them and compare samtId with the database (see frames.py).
+    With slices > 1 the producer only scans its own slice of the index (elasticsearch sliced scroll)
+    so several producers can scan the index in parallel.
+    A single producer pages with search_after instead and sends the cursor of each page along (PAGE_CURSOR frame)
+    so the consumers can acknowledge committed pages and the scan can be resumed.
+    With since given only units updated since then are scanned (delta mode). Employment changes that do not
+    update sidstOpdateret are not found in delta mode, so a full scan should still be run now and then.
+
+    :param queues: list of queues, one for each consumer
+    :param lock: multiprocessing.Lock
+    :param slice_id: int, the slice this producer scans
+    :param slices: int, total number of slices
+    :param since: dict, unit type -> utc datetime to scan from, None for full scan
+    :param newest: dict like (multiprocessing.Manager), set failed here if the scan fails
+    :param cursor: list, search_after cursor to resume the scan from (single producer only)
+    :param includes: list, _source includes (see CvrConnection.get_source_includes) - None for complete documents
+    :param by_type: bool, route units to consumers by type too
+    """
+    t0 = time.time()
+    if slices > 1:
+        name = 'producer-{0}'.format(slice_id)
+    else:
+        name = 'producer'
+    logger = producer_logger(name)
+    with lock:
+        logger.info('Starting producer slice {0}/{1} => {2}'.format(slice_id, slices, os.getpid()))
 
     try:
         cvr = CvrConnection()
-        enh_samtid_map = CvrConnection.make_samtid_dict()
-        dummy = CvrConnection.update_info(samtid=-1, sidstopdateret=CvrConnection.dummy_date)
-        params = {'scroll': cvr.elastic_search_scroll_time, 'size': cvr.elastic_search_scan_size}
-        search = Search(using=cvr.elastic_client, index=cvr.index).query('match_all').params(**params)
-        # search = Search(using=cvr.elastic_client, index=cvr.index).query(elasticsearch_dsl.query.MatchAll()).params(**params)
-
-        generator = search.scan()
-        full_update = False
+        raw_client = create_elastic_connection(cvr.url, (cvr.user, cvr.password), raw=True)
+        if since is None:
+            search = Search(index=cvr.index).query('match_all')
+        else:
+            search = Search(index=cvr.index).query(CvrConnection.make_delta_query(since))
+        if includes is not None:
+            search = search.source(includes)
+        if slices > 1:
+            search = search.extra(slice={'id': slice_id, 'max': slices})
+            page_size = AdaptivePageSize(size=cvr.elastic_search_scan_size, adapt=False, name=name, logger=logger)
+            generator = raw_scan(raw_client, cvr.index, search.to_dict(), page_size,
+                                 scroll=cvr.elastic_search_scroll_time)
+            generator = ((page, hits, None) for (page, hits) in generator)
+        else:
+            page_size = AdaptivePageSize(size=cvr.elastic_search_scan_size, max_size=cvr.scan_max_page_size,
+                                         max_bytes=cvr.scan_max_page_bytes, name=name, logger=logger)
+            generator = search_after_scan(raw_client, cvr.index, search.to_dict(), page_size, cursor=cursor)
         i = 0
-        for obj in tqdm.tqdm(generator):
-            try:
-                i = i+1
-                dat = obj.to_dict()
-                keys = dat.keys()
-                dict_type_set = keys & CvrConnection.source_keymap.values()  # intersects the two key sets
-                if len(dict_type_set) != 1:
-                    print(dict_type_set)
-                    logger.debug('BAD DICT DOWNLOADED CVR UPDATE PRODUCER \n{0} {1}'.format(dat, dict_type_set))                    
-                    continue
-                dict_type = dict_type_set.pop()
-                dat = dat[dict_type]
-                enhedsnummer = dat['enhedsNummer']
-                samtid = dat['samtId']
-                if dat['samtId'] is None:
-                    add_error('Samtid none: enh {0}'.format(enhedsnummer))
-                    dat['samtId'] = -1
-                    samtid = -1
-                current_update = enh_samtid_map[enhedsnummer] if enhedsnummer in enh_samtid_map else dummy
-                
-                if samtid > current_update.samtid:
-                    full_update = True
-                else:
-                    if dict_type == 'Vrdeltagerperson':
-                        continue
-                    full_update = False
-
-                for repeat in range(20):
-                    try:
-                        queue.put((dict_type, dat, full_update), timeout=60)
-                        break
-                    except Exception as e:
-                        logger.debug('Producer timeout failed {0} - retrying {1} - {2} - repeat: {3} - queue full {4} (unreliable)'.format(str(e), enhedsnummer, dict_type, repeat, queue.full()))
-                        if repeat > 10:
-                            raise(e)
-                if (i % 30000 == 0):
-                    logger.debug('{0} rounds'.format(i))                    
-
-            except Exception as e:
-                logger.debug('Producer exception: e: {0} - obj: {1}'.format(e, obj))
-                print('continue producer')
-                # print(obj)
-            # if ((i+1) % 10000) == 0:
-            #     with lock:
-            #         print('{0} objects parsed and inserted into queue'.format(i))
+        progress = tqdm.tqdm(desc='slice {0}/{1}'.format(slice_id, slices), position=slice_id)
+        for seq, (page, hits, page_cursor) in enumerate(generator):
+            put_page(queues, PAGE_SCAN, page, logger, None if page_cursor is None else [seq, page_cursor], by_type)
+            progress.update(hits)
+            j = i + hits
+            if i // 30000 != j // 30000:
+                logger.info('slice {0}/{1}: {2} scanned - {3:.1f} docs/s'.format(
+                    slice_id, slices, j, j / (time.time() - t0)))
+            i = j
+        progress.close()
     except Exception as e:
         print('*** generator error ***', file=sys.stderr)
         logger.debug('generator error: {0}'.format(str(e)))
@@ -746,10 +1415,16 @@ def cvr_update_producer(queue, lock):
         print(type(e))
         #logger.info(e)
         #logger.info(type(e))
+        if newest is not None:
+            newest['failed'] = True
         return
+    finally:
+        # wait for pages spilled to disk to reach the queues
+        for queue in queues:
+            queue.close()
     # Synchronize access to the console
     with lock:
-        logger.info('objects parsing done')
+        logger.info('objects parsing done - slice {0}/{1}: {2} scanned'.format(slice_id, slices, i))
 
     t1 = time.time()
     with lock:
@@ -759,6 +1434,45 @@ def cvr_update_producer(queue, lock):
     #    queue.put(cvr.cvr_sentinel)
 
 
+def cvr_id_producer(queues, lock, enh, fetch_id=0, newest=None, includes=None, by_type=False):
+    """ Producer for phase two of the two phase update.
+    Downloads the given (changed) units in batched ids queries and places the raw pages on the Queue
+
+    :param queues: list of queues, one for each consumer
+    :param lock: multiprocessing.Lock
+    :param enh: list, enhedsnummer of units to download
+    :param fetch_id: int, id of this fetcher - used for logging
+    :param newest: dict like (multiprocessing.Manager), set failed here if download fails
+    :param includes: list, _source includes (see CvrConnection.get_source_includes) - None for complete documents
+    :param by_type: bool, route units to consumers by type too
+    """
+    t0 = time.time()
+    name = 'id-producer-{0}'.format(fetch_id)
+    logger = producer_logger(name)
+    with lock:
+        logger.info('Starting id producer {0} - {1} units => {2}'.format(fetch_id, len(enh), os.getpid()))
+    try:
+        cvr = CvrConnection()
+        page_size = AdaptivePageSize(size=256, max_size=2048, name=name, logger=logger)
+        progress = tqdm.tqdm(total=len(enh), desc='fetch {0}'.format(fetch_id), position=fetch_id)
+        for page, requested in cvr.fetch_unit_pages(enh, page_size=page_size, includes=includes):
+            put_page(queues, PAGE_FULL, page, logger, by_type=by_type)
+            progress.update(requested)
+        progress.close()
+    except Exception as e:
+        print('*** id fetch error ***', file=sys.stderr)
+        logger.debug('id fetch error: {0}'.format(str(e)))
+        print(e)
+        if newest is not None:
+            newest['failed'] = True
+        return
+    finally:
+        for queue in queues:
+            queue.close()
+    with lock:
+        logger.info('Id Producer Done. Time Used: {0}'.format(time.time()-t0))
+
+
 def test_producer():
     print('test producer')
 
@@ -767,13 +1481,23 @@ def test_producer():
             self.counter = {}
 
         def put(self, obj, timeout=None):
-            dict_type = obj[0]
-            if dict_type in self.counter:
-                self.counter[dict_type] += 1
-            else:
-                self.counter[dict_type] = 1
+            for (kind, payload) in decode_frames(obj):
+                if kind == PAGE_CURSOR:
+                    continue
+                for source in page_sources(payload):
+                    dict_type = tuple(source.keys())[0]
+                    if dict_type in self.counter:
+                        self.counter[dict_type] += 1
+                    else:
+                        self.counter[dict_type] = 1
             #dat = obj[1]
 
+        def full(self):
+            return False
+
+        def close(self):
+            pass
+
 
     class dumlock():
         def __enter__(self):
@@ -782,14 +1506,200 @@ def test_producer():
         def __exit__(self, exc_type, exc_val, exc_tb):
             pass
 
-    cvr_update_producer(dumqueue(), dumlock())
+    cvr_update_producer([dumqueue()], dumlock())
+
+
+class PageTracker(object):
+    """ Keeps track of the checkpointed pages a consumer has not committed all units from yet.
+    A page is acknowledged on the ack queue when the last of its units is committed to the database.
+    """
+
+    def __init__(self, ack_queue):
+        """
+        :param ack_queue: multiprocessing.Queue or None if the scan is not checkpointed
+        """
+        self.ack_queue = ack_queue
+        self.pending = {}
+
+    def add_page(self, seq, cursor, count):
+        """
+        :param seq: int, page number in scan
+        :param cursor: list, search_after cursor of the page
+        :param count: int, number of units from the page waiting to be committed
+        """
+        if count == 0:
+            self.ack(seq, cursor)
+        else:
+            self.pending[seq] = [count, cursor]
 
+    def committed(self, seqs):
+        """ Units committed
 
-def cvr_update_consumer(queue, lock):
+        :param seqs: list, page number of each unit committed (None for units not from checkpointed pages)
+        """
+        for seq in seqs:
+            if seq is None:
+                continue
+            page = self.pending[seq]
+            page[0] -= 1
+            if page[0] == 0:
+                del self.pending[seq]
+                self.ack(seq, page[1])
+
+    def ack(self, seq, cursor):
+        if self.ack_queue is not None:
+            self.ack_queue.put((seq, cursor))
+
+
+class WriteBehind(object):
+    """ Write behind stage of a consumer. A parsed batch is handed to a background writer thread and the consumer
+    parses the next batch while it is written, so parsing and the database waits overlap.
+    Each batch in flight has its own parsers (sharing the dimension caches of the CvrConnection) and the batches
+    are written one at a time in order. At most in_flight batches wait for the writer - 0 updates synchronously.
+    When a write fails the writer skips the batches after it. The consumer then drops the parsers and dimension
+    caches and updates the failed and skipped batches itself, one by one if needed (consumer_update_batch).
     """
 
+    def __init__(self, cvr, tracker, logger, in_flight=1):
+        """
+        :param cvr: CvrConnection
+        :param tracker: PageTracker, written units are reported here
+        :param logger: logging.Logger
+        :param in_flight: int, max number of batches waiting to be written
+        """
+        self.cvr = cvr
+        self.tracker = tracker
+        self.logger = logger
+        self.in_flight = in_flight
+        self.writer = ThreadPoolExecutor(max_workers=1) if in_flight > 0 else None
+        # (future, batch, dict_type, full_update, seqs, parser set) in the order written
+        self.pending = deque()
+        # parser sets (unit type -> DataParser) not used by a batch in flight
+        self.free = [{} for _ in range(in_flight + 1)]
+        # set by the writer thread when a write fails - the later batches are skipped
+        self.failed = False
+        # number of resets - batches parsed before a reset are updated again
+        self.generation = 0
+
+    def submit(self, batch, dict_type, full_update, seqs):
+        """ Parse batch and hand it to the writer - waits while in_flight batches are waiting already
+
+        :param batch: list of dicts with cvr data
+        :param dict_type: str, cvr object type
+        :param full_update: bool, full update or employment only
+        :param seqs: list, page number of each unit (see PageTracker)
+        """
+        if self.writer is None:
+            consumer_update_batch(self.cvr, batch, dict_type, full_update, self.logger)
+            self.tracker.committed(seqs)
+            return
+        batch = list(batch)
+        seqs = list(seqs)
+        generation = self.generation
+        parser_set = None
+        parsers = None
+        if full_update:
+            parser_set = self.free.pop()
+            if dict_type not in parser_set:
+                parser_set[dict_type] = data_scanner.DataParser(_type=dict_type, keystore=self.cvr.get_keystore())
+            try:
+                parsers = self.cvr.parse_batch(batch, parser_set[dict_type])
+            except Exception as e:
+                # the parsers and key store hold part of the batch - start over and update it directly
+                self.logger.debug('Exception parsing batch in consumer: {0} - {1}'.format(os.getpid(), str(e)))
+                self.drain()
+                self.reset()
+                consumer_update_batch(self.cvr, batch, dict_type, full_update, self.logger)
+                self.tracker.committed(seqs)
+                return
+        while len(self.pending) >= self.in_flight:
+            self.finish_oldest()
+        if generation != self.generation:
+            # parsed with the dimension caches dropped after a failed write
+            consumer_update_batch(self.cvr, batch, dict_type, full_update, self.logger)
+            self.tracker.committed(seqs)
+            return
+        future = self.writer.submit(self.write, batch, dict_type, full_update, parser_set, parsers)
+        self.pending.append((future, batch, dict_type, full_update, seqs, parser_set))
+
+    def write(self, batch, dict_type, full_update, parser_set, parsers):
+        """ Runs in the writer thread
+
+        :return: bool, False if skipped after a failed write
+        """
+        if self.failed:
+            return False
+        try:
+            if full_update:
+                CvrConnection.write_batch(batch, dict_type, parser_set[dict_type], parsers)
+            else:
+                self.cvr.update_employment_only(batch, dict_type)
+        except Exception:
+            self.failed = True
+            raise
+        return True
+
+    def finish_oldest(self):
+        """ Wait for the oldest batch in flight to be written """
+        future, batch, dict_type, full_update, seqs, parser_set = self.pending.popleft()
+        try:
+            written = future.result()
+        except Exception as e:
+            self.logger.debug('Exception in consumer: {0} - {1}'.format(os.getpid(), str(e)))
+            print('Exception in consumer: {0} - {1}'.format(os.getpid(), str(e)))
+            written = False
+        if written:
+            self.tracker.committed(seqs)
+            if parser_set is not None:
+                self.free.append(parser_set)
+            return
+        # this batch failed - the writer skips the rest
+        retry = [(batch, dict_type, full_update, seqs)]
+        while len(self.pending) > 0:
+            future, batch, dict_type, full_update, seqs, _ = self.pending.popleft()
+            try:
+                future.result()
+            except Exception:
+                pass
+            retry.append((batch, dict_type, full_update, seqs))
+        self.reset()
+        for (batch, dict_type, full_update, seqs) in retry:
+            consumer_update_batch(self.cvr, batch, dict_type, full_update, self.logger)
+            self.tracker.committed(seqs)
+
+    def reset(self):
+        """ Drop all parsers and the dimension caches - no batch may be in flight """
+        self.cvr.reset_data_parsers()
+        self.free = [{} for _ in range(self.in_flight + 1)]
+        self.failed = False
+        self.generation += 1
+
+    def drain(self):
+        """ Wait for all batches in flight """
+        while len(self.pending) > 0:
+            self.finish_oldest()
+
+    def close(self):
+        self.drain()
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+
+
+def cvr_update_consumer(queue, lock, newest=None, ack_queue=None, samtid_index=None, preload_dimensions=False,
+                        dimension_cache_bytes=2**29, commit_workers=commit_executor.default_workers, write_behind=1):
+    """ Consumer function that updates the database with units from the Queue.
+    Queue items are raw pages in frames (see frames.py) or (dict_type, dat, full_update) tuples
+
     :param queue: multiprocessing.Queue
     :param lock: multiprocessing.Lock
+    :param newest: dict like (multiprocessing.Manager), newest sidstOpdateret seen for each unit type is stored here
+    :param ack_queue: multiprocessing.Queue, committed checkpointed pages are acknowledged here
+    :param samtid_index: SamtidIndex, shared versions of the units in the database - loaded when needed if None
+    :param preload_dimensions: bool, read the dimension tables into memory at start
+    :param dimension_cache_bytes: int, memory cap of the dimension caches
+    :param commit_workers: int, threads writing to the database
+    :param write_behind: int, parsed batches waiting to be written while the next is parsed - 0 to parse and write
+    in turn
     :return:
     """
 
@@ -819,11 +1729,20 @@ def cvr_update_consumer(queue, lock):
         with lock:
             logger.info('setup database connection - lost in spawn/fork')    
     
+    commit_executor.configure(commit_workers)
     cvr = CvrConnection()
-    # enh_samtid_map = CvrConnection.make_samtid_dict()
-    # dummy = CvrConnection.update_info(samtid=-1, sidstopdateret=CvrConnection.dummy_date)
+    cvr.preload_dimensions = preload_dimensions
+    cvr.dimension_cache_bytes = dimension_cache_bytes
+    # without a shared index the samtid map is loaded when the first scan page arrives
+    sorter = DocumentSorter(samtid_index)
+    tracker = PageTracker(ack_queue)
+    writer = WriteBehind(cvr, tracker, logger, write_behind)
+    quarantine = document_check.Quarantine()
     dicts = {x: list() for x in CvrConnection.source_keymap.values()}
     emp_dicts = {x: list() for x in CvrConnection.source_keymap.values()}
+    # page number of the units in dicts/emp_dicts
+    dict_seqs = {x: list() for x in CvrConnection.source_keymap.values()}
+    emp_seqs = {x: list() for x in CvrConnection.source_keymap.values()}
     i = 0
     while True:
         # try:
@@ -836,52 +1755,41 @@ def cvr_update_consumer(queue, lock):
                 break
             except Exception as e:
                 logger.debug('Consumer timeout reached - repeats {1}, retrying - e: {0} '.format(e, repeats))
-        try:  # move this
-            if obj == cvr.cvr_sentinel:
-                logger.info('sentinel found - Thats it im out of here')
-                # queue.put(obj)
-                break
-            elif obj == cvr.cvr_nothing:
-                logger.debug('Nothing returned for consumer in long time - breaking')
-                break
-            if obj is None:
-                continue
-            #logger.info('Got some data {0}'.format(i))
+        if obj is None:
+            continue
+        if type(obj) is bytes:
+            # raw pages from the producers
+            docs = consumer_sort_frames(obj, sorter, logger, tracker, quarantine)
+        elif obj == cvr.cvr_sentinel:
+            logger.info('sentinel found - Thats it im out of here')
+            # queue.put(obj)
+            break
+        elif obj == cvr.cvr_nothing:
+            logger.debug('Nothing returned for consumer in long time - breaking')
+            break
+        else:
             assert len(obj) == 3, 'obj not length 2 - should be tuple of length 3'
-            dict_type = obj[0]
-            dat = obj[1]
-            full_update = obj[2]
-            if full_update:
-                dicts_to_use = dicts
-            else:
-                dicts_to_use =  emp_dicts
-            dicts_to_use[dict_type].append(dat)
-            if len(dicts_to_use[dict_type]) >= cvr.update_batch_size:
-                #logger.info('try to insert {0}'.format(i))
-                t0 = time.time()
+            docs = [tuple(obj) + (None,)]
+            problems = document_check.check_unit(*obj)
+            if len(problems) > 0:
+                quarantine.add({obj[0]: obj[1]}, problems)
+                docs = []
+        try:
+            for (dict_type, dat, full_update, seq) in docs:
                 if full_update:
-                    cvr.update(dicts_to_use[dict_type], dict_type)
+                    dicts_to_use = dicts
+                    seqs_to_use = dict_seqs
                 else:
-                    cvr.update_employment_only(dicts_to_use[dict_type], dict_type)
-                used_time = time.time() - t0
-                #logger.info(' - {0} time used - data inserted {1}'.format(used_time, len(dicts_to_use[dict_type])))
-                dicts_to_use[dict_type].clear()
+                    dicts_to_use = emp_dicts
+                    seqs_to_use = emp_seqs
+                dicts_to_use[dict_type].append(dat)
+                seqs_to_use[dict_type].append(seq)
+                if len(dicts_to_use[dict_type]) >= cvr.update_batch_size:
+                    writer.submit(dicts_to_use[dict_type], dict_type, full_update, seqs_to_use[dict_type])
+                    dicts_to_use[dict_type].clear()
+                    seqs_to_use[dict_type].clear()
         except Exception as e:
             logger.debug('Exception in consumer: {0} - {1}'.format(os.getpid(), str(e)))
-            logger.debug('insert one by one')
-            print('Exception in consumer: {0} - {1}'.format(os.getpid(), str(e)))
-            for enh_type, _dicts in dicts.items():
-                for one_dict in _dicts:
-                    logger.debug('inserting {0}'.format(one_dict['enhedsNummer']))
-                    try:
-                        if full_update:
-                            cvr.update([one_dict], enh_type)
-                        else:
-                            logger.debug('error in emp only')
-                            cvr.update_employment_only([one_dict], enh_type)
-                    except Exception as e:
-                        logger.debug('one insert error\n{0}'.format(str(e)))
-                        logger.debug('enh failed: {0}'.format(one_dict['enhedsNummer']))
         if i % 10000 == 0:
             logger.debug('Consumer {0} rounds completed and alive - '.format(i))
 
@@ -892,10 +1800,85 @@ def cvr_update_consumer(queue, lock):
     logger.debug('Consumer empty cache')
     for enh_type, _dicts in dicts.items():
         if len(_dicts) > 0:
-            cvr.update(_dicts, enh_type)
+            writer.submit(_dicts, enh_type, True, dict_seqs[enh_type])
     for enh_type, _dicts in emp_dicts.items():
         if len(_dicts) > 0:
-            cvr.update_employment_only(_dicts, enh_type)
+            writer.submit(_dicts, enh_type, False, emp_seqs[enh_type])
+    writer.close()
+    quarantine.close()
     t1 = time.time()
     with lock:
+        sorter.store_newest(newest)
         print('Consumer Done. Exiting...{0} - time used {1}'.format(os.getpid(), t1-t0))
+
+
+def consumer_sort_frames(blob, sorter, logger, tracker=None, quarantine=None):
+    """ Decode the raw pages in frames and sort out the units to update.
+    Units that would make the parsers fail are written to the quarantine instead of being returned.
+
+    :param blob: bytes, frames
+    :param sorter: DocumentSorter
+    :param logger: logging.Logger
+    :param tracker: PageTracker, checkpointed pages are registered here
+    :param quarantine: document_check.Quarantine, bad units go here - None to only log them
+    :return: list of (dict_type, dat, full_update, seq) tuples, seq is the page number for checkpointed pages or None
+    """
+    docs = []
+    seq = None
+    cursor = None
+    for (kind, payload) in decode_frames(blob):
+        if kind == PAGE_CURSOR:
+            seq, cursor = json.loads(payload)
+            continue
+        full_update = True if kind == PAGE_FULL else None
+        count = 0
+        for source in page_sources(payload):
+            try:
+                doc = sorter.sort(source, full_update)
+            except Exception as e:
+                logger.debug('Bad document: e: {0} - obj: {1}'.format(e, source))
+                document_check.divert(quarantine, source, ['sort failed: {0}'.format(e)])
+                continue
+            if doc is not None:
+                problems = document_check.check_unit(doc[0], doc[1], doc[2])
+                if len(problems) > 0:
+                    document_check.divert(quarantine, source, problems)
+                    continue
+                docs.append(doc + (seq,))
+                count += 1
+        if seq is not None and tracker is not None:
+            tracker.add_page(seq, cursor, count)
+        seq = None
+    return docs
+
+
+def consumer_update_batch(cvr, batch, dict_type, full_update, logger):
+    """ Update a batch of units - if that fails update them one by one
+
+    :param cvr: CvrConnection
+    :param batch: list of dicts with cvr data
+    :param dict_type: str, cvr object type
+    :param full_update: bool, full update or employment only
+    :param logger: logging.Logger
+    """
+    try:
+        if full_update:
+            cvr.update(batch, dict_type)
+        else:
+            cvr.update_employment_only(batch, dict_type)
+        return
+    except Exception as e:
+        logger.debug('Exception in consumer: {0} - {1}'.format(os.getpid(), str(e)))
+        logger.debug('insert one by one')
+        print('Exception in consumer: {0} - {1}'.format(os.getpid(), str(e)))
+    for one_dict in batch:
+        logger.debug('inserting {0}'.format(one_dict['enhedsNummer']))
+        try:
+            if full_update:
+                cvr.update([one_dict], dict_type)
+            else:
+                logger.debug('error in emp only')
+                cvr.update_employment_only([one_dict], dict_type)
+        except Exception as e:
+            logger.debug('one insert error\n{0}'.format(str(e)))
+            logger.debug('enh failed: {0}'.format(one_dict['enhedsNummer']))
@@ -13,6 +13,9 @@ from . import config, create_session, engine, setup_database_connection
 from . import alchemy_tables
 from .bug_report import add_error
 from . import data_scanner
+from .page_size import AdaptivePageSize, search_after_hits
+from .samtid_index import IdIndex
+from .sql_help import stream_query
 import multiprocessing
 import time
 import sys
@@ -155,11 +158,16 @@ class RegistrationConnection(object):
     
     @staticmethod
     def get_id_dict():
+        """ offentliggoerelseId of the registrations in the database.
+        Streamed from the database in chunks into a sorted array (only membership is tested)
+
+        :return: IdIndex
+        """
         table = alchemy_tables.Registration
         session = create_session()
-        query = session.query(table.offentliggoerelseid,
-                              table.sidstopdateret)
-        existing_data = {x[0]: x[1] for x in query.all()}
+        query = session.query(table.offentliggoerelseid)
+        existing_data = IdIndex.from_chunks(stream_query(query))
+        session.close()
         return existing_data
 
 
@@ -202,15 +210,16 @@ def reg_producer(queue, lock):
         regconn = RegistrationConnection()
         enh_samtid_map = RegistrationConnection.get_id_dict()
 
-        params = {'scroll': regconn.elastic_search_scroll_time, 'size': regconn.elastic_search_scan_size}
-        search = Search(using=regconn.elastic_client, index=regconn.index).query('match_all').params(**params)
-
-        generator = search.scan()
+        search = Search(index=regconn.index).query('match_all')
+        page_size = AdaptivePageSize(size=regconn.elastic_search_scan_size, max_size=8192,
+                                     name='Reg-Producer', logger=logger)
+        generator = search_after_hits(regconn.elastic_client, regconn.index, search.to_dict(),
+                                      [{'_id': 'asc'}], page_size)
         i = 0
         for obj in tqdm.tqdm(generator):
             try:
                 i = i+1
-                dat = obj.to_dict()
+                dat = obj['_source']
                 if dat['offentliggoerelseId'] in enh_samtid_map:
                     continue
                 for repeat in range(20):
@@ -1,13 +1,14 @@
 import pytz
 from bs4 import BeautifulSoup
-import dateutil
 import datetime
+import functools
+from operator import itemgetter
 from dateutil.parser import parse as date_parse
 from .sql_help import SessionInsertCache, SessionKeystoreCache
 from .adresse import beliggenhedsadresse_to_str
 from . import alchemy_tables
 from .bug_report import add_error
-import threading
+from . import commit_executor
 
 
 def get_date(st):
@@ -33,22 +34,41 @@ def parse_sidst_opdateret(st):
     return utc_sidstopdateret
 
 
+@functools.lru_cache(maxsize=128)
+def utc_offset(seconds):
+    """ Fixed offset time zone - cvr uses a few offsets so they are made once
+
+    :param seconds: int, offset from utc
+    :return: datetime.timezone
+    """
+    return datetime.timezone(datetime.timedelta(seconds=seconds))
+
+
+def iso_time_transform(time):
+    """ transform iso strings like 2017-01-29T13:06:04.000+01:00 with datetime.fromisoformat (fastest)
+
+    :param time: str, with utc offset or Z
+    :return: datetime in utc, raises ValueError if the string is not iso format with offset
+    """
+    if time.endswith('Z'):
+        time = time[:-1] + '+00:00'
+    d = datetime.datetime.fromisoformat(time)
+    if d.tzinfo is None:
+        raise ValueError('no utc offset: {0}'.format(time))
+    return d.astimezone(pytz.utc)
+
+
 def fast_time_transform(time):
     """ transform strings like 2017-01-29T13:06:04.000+01:00 fast
                                2014-10-02T20:00:00.000Z
     :param time: str, with utc time
     :return: datetime
     """
-    val = time[0:28]
+    val = time[0:29]
 
     if len(val) > 23 and val[23] != 'Z':
-        utc_sign = val[23]
-        minute = -int(val[27:29])
-        hour = -int(val[24:26])
-        if utc_sign == '+':
-            tzinfo = dateutil.tz.tzoffset(None, hour * 60 * 60 + minute * 60)
-        else:
-            tzinfo = dateutil.tz.tzoffset(None, hour * 60 * 60 + minute * 60)
+        sign = -1 if val[23] == '-' else 1
+        tzinfo = utc_offset(sign * (int(val[24:26]) * 60 * 60 + int(val[27:29]) * 60))
     else:
         tzinfo = pytz.utc
     return datetime.datetime(
@@ -58,11 +78,8 @@ def fast_time_transform(time):
             hour=int(val[11:13]),  # +hour,  # %H
             minute=int(val[14:16]),  # +minute,  # %M
             second=int(val[17:19]),  # %s
-            microsecond=int(val[20:23]),  # microseconds
+            microsecond=int(val[20:23]) * 1000,  # milliseconds
             tzinfo=tzinfo).astimezone(pytz.utc)
-    # tzinfo = dateutil.tz.tzoffset(None, hour * 60 * 60)
-    # int(val[24:26],   # utc offset hour
-    # int(val[27:29]))  # utc offset minute
 
 
 def slow_time_transform(s):
@@ -84,12 +101,18 @@ def slow_time_transform(s):
         return None
 
 
+@functools.lru_cache(maxsize=2**16)
 def utc_transform(s):
     """ transform string to utc datetime
+    Memoized - cvr reuses a small set of sidstOpdateret strings, and the returned datetimes are immutable.
 
     :param s: string representation of datetime with utc info
     :return: datetime in utc timezone
     """
+    try:
+        return iso_time_transform(s)
+    except ValueError:
+        pass
     try:
         return fast_time_transform(s)
     except Exception as e:
@@ -97,6 +120,47 @@ def utc_transform(s):
     return slow_time_transform(s)
 
 
+def compile_row_extractor(keys, timestamps=(), strict=False):
+    """ Compile the field spec of a table once into a function that makes the row of a document.
+    All fields are read with one operator.itemgetter call and the timestamps (last in the row) are made utc.
+
+    :param keys: list of str, fields in row order
+    :param timestamps: list of str, timestamp fields - placed after keys in the row
+    :param strict: bool, missing fields raise KeyError - otherwise they are None
+    :return: function, dict -> tuple
+    """
+    names = tuple(keys) + tuple(timestamps)
+    if len(names) == 1:
+        name = names[0]
+
+        def strict_getter(data):
+            return data[name],
+    else:
+        strict_getter = itemgetter(*names)
+    if strict:
+        getter = strict_getter
+    else:
+        def getter(data):
+            try:
+                return strict_getter(data)
+            except KeyError:
+                return tuple(data.get(x) for x in names)
+    n = len(keys)
+    if len(timestamps) == 0:
+        return getter
+    if len(timestamps) == 1:
+        def extract(data):
+            row = getter(data)
+            ts = row[n]
+            return row[:n] + ((utc_transform(ts) if ts is not None else None), )
+        return extract
+
+    def extract(data):
+        row = getter(data)
+        return row[:n] + tuple(utc_transform(x) if x is not None else None for x in row[n:])
+    return extract
+
+
 class ParserInterface(object):
     """ Trivial interface for parser object """
     def insert(self, data):
@@ -105,6 +169,13 @@ class ParserInterface(object):
     def commit(self):
         raise NotImplementedError('Implement in subclass')
 
+    def source_fields(self):
+        """ Top level fields of the cvr unit read by this parser - used as _source includes when downloading
+
+        :return: set of str, None if not known (the parser may read any field)
+        """
+        return None
+
 
 class Parser(ParserInterface):
     """ Abstract class for parsing cvr data with sql_cache.
@@ -125,7 +196,7 @@ class Parser(ParserInterface):
 
 class ParserList(ParserInterface):
     """ Simple class for storing list of parser objects
-        using threading for commits. Consider bounding thread count. May not matter.
+        Commits run on the commit executor of the process - the parsers writing the same table one at a time.
     """
 
     def __init__(self):
@@ -136,21 +207,33 @@ class ParserList(ParserInterface):
             l.insert(data)
 
     def commit(self):
-        
-        def worker(list_index):
-            self.listeners[list_index].commit()
+        commit_executor.run(self.commit_tasks())
+
+    def commit_tasks(self):
+        """ Commits of the parsers in the list and in nested lists
 
-        threads = []
-        for i in range(len(self.listeners)):
-            t = threading.Thread(target=worker, args=(i,))
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
+        :return: list of (table class, commit function) - the parser itself if it does not have one table
+        """
+        tasks = []
+        for l in self.listeners:
+            if isinstance(l, ParserList):
+                tasks.extend(l.commit_tasks())
+            else:
+                tasks.append((getattr(getattr(l, 'db', None), 'table_class', l), l.commit))
+        return tasks
 
     def add_listener(self, obj):
         self.listeners.append(obj)
 
+    def source_fields(self):
+        fields = set()
+        for l in self.listeners:
+            l_fields = l.source_fields()
+            if l_fields is None:
+                return None
+            fields.update(l_fields)
+        return fields
+
 
 class StaticParser(Parser):
     """ Simple class for parsing static erst data """
@@ -159,13 +242,13 @@ class StaticParser(Parser):
         super().__init__(table_class, table_columns)
         self.timestamps = json_timestamps
         self.json_fields = json_fields
+        self.extract = compile_row_extractor(json_fields, json_timestamps)
 
     def insert(self, data):
-        dat = [data[x] if x in data else None for x in self.json_fields]
-        time_dat = [data[x] if (x in data and data[x] is not None) else None for x in self.timestamps]
-        time_dat = [utc_transform(x) if x is not None else None for x in time_dat]
-        dat = tuple(dat + time_dat)
-        self.db.insert(dat)
+        self.db.insert(self.extract(data))
+
+    def source_fields(self):
+        return set(self.json_fields) | set(self.timestamps)
 
 
 class UploadData(Parser):
@@ -195,6 +278,9 @@ class UploadData(Parser):
                 hb = tuple(z[df].strip() if type(z[df]) is str else z[df] for df in self.data_fields)
                 self.db.insert((ukey, hb))
 
+    def source_fields(self):
+        return set(self.json_fields)
+
 
 class UploadBrancheData(Parser):
 
@@ -218,6 +304,9 @@ class UploadBrancheData(Parser):
                 except Exception as e:
                     add_error('bad key in upload branche {0} {1}'.format(e, z))
 
+    def source_fields(self):
+        return set(self.json_fields)
+
 
 class IdentityDict(object):
     def __getitem__(self, item):
@@ -251,8 +340,12 @@ class UploadMappedUpdates(Parser):
 
     def __init__(self):
         """ Class for uploading data to cvr updates table
+        The mapped values are looked up when the rows are committed, so the values can be inserted and mapped
+        by other parsers in the same pass over the data (see data_scanner.DataParser.parse)
         """
         self.updatemap_list = []
+        # rows with values not yet mapped to ids: (enh, update_mapping, value, gyldigfra, gyldigtil, sidstopdateret)
+        self.pending = []
         table = alchemy_tables.Update
         columns = [table.enhedsnummer,
                    table.felttype,
@@ -286,13 +379,28 @@ class UploadMappedUpdates(Parser):
                         continue
                     if type(val) is str:
                         val = val.strip()
-                dat = update_mapping.field_map[val]
                 tfrom, tto, utc_sidst_opdateret = get_date(z)
-                tup = (enh, update_mapping.field_type, dat, tfrom, tto, utc_sidst_opdateret)
+                tup = (enh, update_mapping, val, tfrom, tto, utc_sidst_opdateret)
                 upload.append(tup)
             # remove duplicates
-        for x in set(upload):
-            self.db.insert(x)
+        self.pending.extend(set(upload))
+
+    def resolve(self):
+        """ Map the values of the pending rows to ids """
+        for (enh, update_mapping, val, tfrom, tto, utc_sidst_opdateret) in self.pending:
+            dat = update_mapping.field_map[val]
+            self.db.insert((enh, update_mapping.field_type, dat, tfrom, tto, utc_sidst_opdateret))
+        self.pending = []
+
+    def commit(self):
+        try:
+            self.resolve()
+        finally:
+            self.pending = []
+        self.db.commit()
+
+    def source_fields(self):
+        return {'enhedsNummer'} | {x.json_field for x in self.updatemap_list}
 
 
 class UploadLivsforloeb(Parser):
@@ -310,6 +418,9 @@ class UploadLivsforloeb(Parser):
             dat = tuple([enh, tfrom, tto, utc_sidstopdateret])
             self.db.insert(dat)
 
+    def source_fields(self):
+        return {'enhedsNummer', 'livsforloeb'}
+
 
 class UploadEmployment(Parser):
     """ Simple class for parsing employment from cvr data file """
@@ -319,16 +430,20 @@ class UploadEmployment(Parser):
         super().__init__(table_class, columns, keystore=None)
         self.dict_field = dict_field
         self.keys = keys
+        self.extract = compile_row_extractor(keys, ['sidstOpdateret'], strict=True)
 
     def insert(self, data):
         enh = data['enhedsNummer']
         if self.dict_field not in data:
             # print('Error field missing {0} - {1}'.format(enh, self.dict_field))
             return
+        extract = self.extract
+        insert = self.db.insert
         for entry in data[self.dict_field]:
-            sidstopdateret = parse_sidst_opdateret(entry)
-            dat = tuple([enh] + [entry[x] for x in self.keys] + [sidstopdateret])
-            self.db.insert(dat)
+            insert((enh, ) + extract(entry))
+
+    def source_fields(self):
+        return {'enhedsNummer', self.dict_field}
 
 
 def get_upload_employment_year():
@@ -458,6 +573,9 @@ class AttributParser(Parser):
                 upload.append(dat)
         [self.db.insert(x) for x in set(upload)]
 
+    def source_fields(self):
+        return {'enhedsNummer', 'attributter'}
+
 
 class RegistrationParser(Parser):
     """ Class for parsing raw registrations from Danish Business Authority 
@@ -557,6 +675,9 @@ class AddressParser(Parser):
                 bl = beliggenhedsadresse_to_str(z)
                 self.db.insert((enh, field, ad_status, aid, tfrom, tto, bl, utc_sidstopdateret))
 
+    def source_fields(self):
+        return {'enhedsNummer'} | set(self.json_fields)
+
 
 class ParserFactory(object):
     @staticmethod
@@ -0,0 +1,119 @@
+""" Length prefixed byte frames for moving raw elasticsearch pages from producers to consumers
+
+The producers do not parse the documents they download. Each search/scroll response is passed on
+as the raw json bytes behind a small header (length, kind), and the consumer parses the documents.
+The producer only decodes the response (ujson) to count hits, find the scroll id and sort values, and to
+split the page between several consumers.
+"""
+import struct
+import ujson as json
+
+header = struct.Struct('<IB')
+# kinds of frames
+PAGE_SCAN = 0  # page from scan - consumer checks samtId against the database
+PAGE_FULL = 1  # page of units known to be changed - all full updates
+PAGE_CURSOR = 2  # json [seq, cursor] of the following page in a checkpointed scan
+
+
+def encode_frame(kind, payload):
+    """ Encode raw page as a frame
+
+    :param kind: int, PAGE_SCAN or PAGE_FULL
+    :param payload: str or bytes, raw json response from elasticsearch
+    :return: bytes
+    """
+    if type(payload) is str:
+        payload = payload.encode('utf-8')
+    return header.pack(len(payload), kind) + payload
+
+
+def decode_frames(blob):
+    """ Split packed frames
+
+    :param blob: bytes, one or more concatenated frames
+    :return: generator of (kind, payload bytes)
+    """
+    offset = 0
+    end = len(blob)
+    while offset < end:
+        length, kind = header.unpack_from(blob, offset)
+        offset += header.size
+        yield kind, blob[offset:offset + length]
+        offset += length
+
+
+def page_sources(payload):
+    """ Decode raw page and return the _source of each hit
+
+    :param payload: bytes, raw json response
+    :return: list of dicts
+    """
+    page = json.loads(payload)
+    return [hit['_source'] for hit in page['hits']['hits']]
+
+
+def page_info(page):
+    """ Read what the producer needs from a raw page
+
+    :param page: str, raw json response
+    :return: str (scroll id or None), int (number of hits)
+    """
+    response = json.loads(page)
+    if 'hits' not in response or 'hits' not in response['hits']:
+        raise ValueError('No hits in elasticsearch response: {0}'.format(page[0:1000]))
+    shards = response.get('_shards', None)
+    if shards is None or shards.get('failed', None) != 0:
+        raise ValueError('Shard failures in elasticsearch response: {0}'.format(shards))
+    return response.get('_scroll_id', None), len(response['hits']['hits'])
+
+
+def page_last_sort(page):
+    """ Get the sort values of the last hit in a raw page (the search_after cursor).
+
+    :param page: str, raw json response from a sorted search
+    :return: list, sort values
+    """
+    hits = json.loads(page)['hits']['hits']
+    if len(hits) == 0 or 'sort' not in hits[-1]:
+        raise ValueError('No sort values in elasticsearch response')
+    return hits[-1]['sort']
+
+
+empty_page = '{"hits":{"hits":[]}}'
+
+
+def consumer_of(enh, dict_type, consumers, by_type=False):
+    """ Choose the consumer of a unit, so the same unit always goes to the same consumer
+
+    :param enh: int, enhedsnummer
+    :param dict_type: str, unit type (Vrvirksomhed, ...) or None if unknown
+    :param consumers: int, number of consumers
+    :param by_type: bool, give each unit type its own group of consumers (needs consumers >= 3)
+    :return: int, consumer index
+    """
+    types = ('Vrvirksomhed', 'VrproduktionsEnhed', 'Vrdeltagerperson')
+    if by_type and consumers >= len(types) and dict_type in types:
+        group = types.index(dict_type)
+        group_size = consumers // len(types)
+        first = group * group_size
+        if group == len(types) - 1:
+            group_size = consumers - first
+        return first + enh % group_size
+    return enh % consumers
+
+
+def split_page(page, consumers, by_type=False):
+    """ Split raw page into a page for each consumer by the enhedsnummer (document _id) of the hits
+
+    :param page: str, raw json response
+    :param consumers: int, number of consumers
+    :param by_type: bool, see consumer_of
+    :return: list of str, page for each consumer (empty_page if it gets no hits)
+    """
+    parts = [[] for _ in range(consumers)]
+    for hit in json.loads(page)['hits']['hits']:
+        source = hit.get('_source', {})
+        dict_type = next(iter(source), None)
+        parts[consumer_of(int(hit['_id']), dict_type, consumers, by_type)].append(hit)
+    return [json.dumps({'hits': {'hits': hits}}, ensure_ascii=False, escape_forward_slashes=False)
+            if len(hits) > 0 else empty_page for hits in parts]
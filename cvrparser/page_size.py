@@ -0,0 +1,129 @@
+""" Adaptive page size for elasticsearch downloads
+
+The best page size depends on round trip latency and on how large the documents are, so instead of a fixed size
+the controller measures documents per second for a few pages at a time and moves the size up or down within bounds.
+"""
+import logging
+import time
+
+# default index.max_result_window of elasticsearch - requests with a larger size are rejected
+max_result_window = 10000
+
+
+class AdaptivePageSize(object):
+    """ Hill climbing page size controller.
+    Pages are recorded in windows, after each window the size is multiplied (or divided) by factor and
+    the direction is reversed when throughput dropped. Pages are kept below max_bytes.
+    """
+
+    def __init__(self, size=128, min_size=16, max_size=4096, max_bytes=2**25, factor=1.5, window=8,
+                 adapt=True, name='scan', logger=None):
+        """
+        :param size: int, initial page size
+        :param min_size: int, smallest page size
+        :param max_size: int, largest page size - at most max_result_window
+        :param max_bytes: int, do not grow pages larger than this many bytes
+        :param factor: float, change of page size between windows
+        :param window: int, number of pages measured for each size
+        :param adapt: bool, if false the size is fixed and only throughput is logged (scroll)
+        :param name: str, name used in log
+        :param logger: logging.Logger
+        """
+        max_size = min(max_size, max_result_window)
+        self.size = max(min_size, min(max_size, size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.factor = factor
+        self.window = window
+        self.adapt = adapt
+        self.name = name
+        self.logger = logger if logger is not None else logging.getLogger('cvrparser')
+        self.direction = 1
+        self.last_rate = None
+        self.best = (self.size, 0.0)
+        self.pages = 0
+        self.docs = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.total_docs = 0
+        self.total_seconds = 0.0
+
+    def record(self, hits, nbytes, seconds):
+        """ Record a downloaded page
+
+        :param hits: int, documents in page
+        :param nbytes: int, size of page (0 if unknown)
+        :param seconds: float, time used on the request
+        """
+        self.pages += 1
+        self.docs += hits
+        self.bytes += nbytes
+        self.seconds += seconds
+        self.total_docs += hits
+        self.total_seconds += seconds
+        if self.pages >= self.window:
+            self.next_size()
+
+    def next_size(self):
+        """ End of window - log throughput and choose the next page size """
+        rate = self.docs / max(self.seconds, 1e-6)
+        page_bytes = self.bytes / self.pages
+        doc_bytes = self.bytes / max(self.docs, 1)
+        if rate > self.best[1]:
+            self.best = (self.size, rate)
+        size = self.size
+        if self.adapt:
+            if self.last_rate is not None and rate < self.last_rate:
+                self.direction = -self.direction
+            if self.direction > 0:
+                size = int(size * self.factor)
+            else:
+                size = int(size / self.factor)
+            if doc_bytes > 0:
+                size = min(size, int(self.max_bytes / doc_bytes))
+            size = max(self.min_size, min(self.max_size, size))
+        log = self.logger.info if size != self.size else self.logger.debug
+        log('{0}: page size {1} - {2:.1f} docs/s - {3:.0f} kB/page -> page size {4}'.format(
+            self.name, self.size, rate, page_bytes / 1024, size))
+        self.last_rate = rate
+        self.size = size
+        self.pages = 0
+        self.docs = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def summary(self):
+        """ Log the overall throughput and the best page size seen """
+        rate = self.total_docs / max(self.total_seconds, 1e-6)
+        best = self.best if self.best[1] > 0 else (self.size, rate)
+        self.logger.info('{0}: {1} docs - {2:.1f} docs/s in requests - best page size {3} ({4:.1f} docs/s)'.format(
+            self.name, self.total_docs, rate, best[0], best[1]))
+
+
+def search_after_hits(client, index, body, sort, page_size, cursor=None):
+    """ Page through search results with search_after and adaptive page size
+
+    :param client: Elasticsearch
+    :param index: str, index to search
+    :param body: dict, search body
+    :param sort: list, sort of the search - must be unique per document
+    :param page_size: AdaptivePageSize
+    :param cursor: list, sort values to start after - None to start from the beginning
+    :return: generator of hits
+    """
+    body = dict(body)
+    body['sort'] = sort
+    while True:
+        body['size'] = min(page_size.size, max_result_window)
+        if cursor is not None:
+            body['search_after'] = cursor
+        t0 = time.time()
+        response = client.search(index=index, body=body)
+        hits = response['hits']['hits']
+        page_size.record(len(hits), 0, time.time() - t0)
+        if len(hits) == 0:
+            break
+        cursor = hits[-1]['sort']
+        yield from hits
+    page_size.summary()
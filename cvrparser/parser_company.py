@@ -3,6 +3,47 @@ from . import parser_organisation
 from . import alchemy_tables
 from . import create_session
 from .bug_report import add_error
+import threading
+
+
+class StatusCodeCache(object):
+    """ Process wide map of status codes (statuskode, kreditoplysningskode) -> statusid shared by all company parsers.
+    The table is read on first use and again only when the version is bumped, that is when UploadStatusTyper has
+    inserted new codes (or a code is missing because another process inserted it).
+    """
+
+    def __init__(self):
+        self.field_map = {}
+        self.version = 0
+        self.loaded_version = -1
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """ New codes are in the table - read it again on next use """
+        with self.lock:
+            self.version += 1
+
+    def get(self):
+        """ The status code map - reads the table if it changed since last read
+
+        :return: dict, (statuskode, kreditoplysningskode) -> statusid
+        """
+        with self.lock:
+            if self.loaded_version != self.version:
+                version = self.version
+                session = create_session()
+                stat_table = alchemy_tables.Statuskode
+                query = session.query(stat_table.statusid,
+                                      stat_table.statuskode,
+                                      stat_table.kreditoplysningskode)
+                dat = query.all()
+                session.close()
+                self.field_map = {(y, z): x for (x, y, z) in dat}
+                self.loaded_version = version
+            return self.field_map
+
+
+status_codes = StatusCodeCache()
 
 
 class UploadStatusTyper(fp.Parser):
@@ -13,6 +54,7 @@ class UploadStatusTyper(fp.Parser):
         columns = [table_class.statuskode, table_class.kreditoplysningskode, table_class.statustekst, table_class.kreditoplysningtekst]
         super().__init__(table_class=table_class, columns=columns, keystore=key_store)
         self.keystore = key_store
+        self.new_codes = 0
 
     def insert(self, data):
         for z in data['status']:
@@ -23,6 +65,19 @@ class UploadStatusTyper(fp.Parser):
             dat = [z.get(x, 'None') for x in self.keys]
             # dat = (z['statuskode'], z['kreditoplysningkode'])
             self.db.insert((key, dat))
+            self.new_codes += 1
+
+    def commit(self):
+        """ Insert the new status codes and tell the shared status code map to read them """
+        try:
+            self.db.commit()
+        finally:
+            if self.new_codes > 0:
+                status_codes.invalidate()
+            self.new_codes = 0
+
+    def source_fields(self):
+        return {'status'}
 
 
 class StatusKoderMap(fp.Parser):
@@ -39,16 +94,10 @@ class StatusKoderMap(fp.Parser):
                    table.gyldigtil,
                    table.sidstopdateret]
         super().__init__(table_class=table, columns=columns, keystore=None)
-        session = create_session()
-        stat_table = alchemy_tables.Statuskode
-        query = session.query(stat_table.statusid,
-                              stat_table.statuskode,
-                              stat_table.kreditoplysningskode)
-        dat = query.all()
-        session.close()
-        self.field_map = {(y, z): x for (x, y, z) in dat}
         self.field_type = 'status'
-    
+        # rows waiting for the status id: (enh, (statuskode, kreditoplysningskode), gyldigfra, gyldigtil)
+        self.pending = []
+
     def insert(self, data):
         enh = data['enhedsNummer'] 
         for z in data['status']:
@@ -56,10 +105,25 @@ class StatusKoderMap(fp.Parser):
             if val[0] is None or val[1] is None:
                 add_error('Statuskode - bad statuskode: {0}'.format(enh))
                 continue
-            dat = self.field_map[val]
             tfrom, tto, utc_sidstopdateret = fp.get_date(z)
-            dat = (enh, self.field_type, dat, tfrom, tto)
-            self.db.insert(dat)
+            self.pending.append((enh, val, tfrom, tto))
+
+    def commit(self):
+        """ Look up the status ids (the codes are inserted by UploadStatusTyper in the same pass) and commit """
+        try:
+            field_map = status_codes.get()
+            for (enh, val, tfrom, tto) in self.pending:
+                if val not in field_map:
+                    # inserted by another process
+                    status_codes.invalidate()
+                    field_map = status_codes.get()
+                self.db.insert((enh, self.field_type, field_map[val], tfrom, tto))
+        finally:
+            self.pending = []
+        self.db.commit()
+
+    def source_fields(self):
+        return {'enhedsNummer', 'status'}
 
 
 class VirksomhedParserFactory(object):
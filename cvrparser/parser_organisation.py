@@ -1,58 +1,54 @@
-import pdb
 from .field_parser import Parser, ParserInterface, get_date
 from .sql_help import SessionUpdateCache, SessionInsertCache
 from .bug_report import add_error
 from . import alchemy_tables
 
 
-def parse_udggaende(spalt, vaerdi):
+def parse_udggaende(spalt, vaerdi, enhedsnummer=None):
+    """ Check that the indgaaende/udgaaende of a spaltning or fusion look as expected - surprises are reported
+    with add_error, the data is inserted anyway
+
+    :param spalt: dict, spaltning or fusion of a company
+    :param vaerdi: str, Spaltning or Fusion
+    :param enhedsnummer: int, the company
+    """
     keys = ['udgaaende', 'indgaaende']
     if (len(spalt['udgaaende']) > 0) and (len(spalt['indgaaende']) > 0) and (spalt['udgaaende'] != spalt['indgaaende']):
-        print('in != ud', 'lets do something anyways')
-        
+        add_error('{0} in != ud: enh {1}'.format(vaerdi, enhedsnummer))
+
     for key in keys:
         if len(spalt[key]) == 0:
             continue
         elif len(spalt[key]) > 1:
-            print('udgaaende len > 1')
-            pdb.set_trace()
+            add_error('{0} {1} len > 1: enh {2}'.format(vaerdi, key, enhedsnummer))
         else:
             tmp = spalt[key][0]
             if len(tmp['vaerdier']) != 1:
-                print('more than one vaerdier')
-                pdb.set_trace()
+                add_error('{0} {1} more than one vaerdier: enh {2}'.format(vaerdi, key, enhedsnummer))
             if tmp['type'] != 'FUNKTION':
-                print('type not funktion')
-                pdb.set_trace()
+                add_error('{0} {1} type not funktion: {2} enh {3}'.format(vaerdi, key, tmp['type'], enhedsnummer))
             for v in tmp['vaerdier']:
                 if v['vaerdi'] != vaerdi:
-                    print('not Spaltning/Fusion in indgaaende/udgaaende')
-                    pdb.set_trace()
-                if (v['periode'] != spalt['organisationsNavn'][0]['periode']) and \
+                    add_error('{0} {1} vaerdi is {2}: enh {3}'.format(vaerdi, key, v['vaerdi'], enhedsnummer))
+                if (len(spalt['organisationsNavn']) > 0) and \
+                        (v['periode'] != spalt['organisationsNavn'][0]['periode']) and \
                         (spalt['organisationsNavn'][0]['periode']['gyldigTil'] is not None):
-                    print('periodes not matching', v['periode'], spalt['organisationsNavn'][0]['periode'])
-                    pdb.set_trace()
+                    add_error('{0} {1} periodes not matching {2} {3}: enh {4}'.format(
+                        vaerdi, key, v['periode'], spalt['organisationsNavn'][0]['periode'], enhedsnummer))
 
 
 def spalt_parser(dat):
-    if 'spaltninger' not in dat:
-        print('Spaltning field missing')
-    if len(dat['spaltninger']) > 0:
-        spalt = dat['spaltninger']
-        for s in spalt:
-            if len(s['organisationsNavn']) != 1:
-                add_error('More Org Names: {0}',format(dat))
-            parse_udggaende(s, 'Spaltning')
+    for s in dat['spaltninger']:
+        if len(s['organisationsNavn']) != 1:
+            add_error('Spaltning more org names: enh {0}'.format(dat['enhedsNummer']))
+        parse_udggaende(s, 'Spaltning', dat['enhedsNummer'])
 
 
 def fusion_parser(dat):
-    if len(dat['fusioner']) > 0:
-        fus = dat['fusioner']
-        for f in fus:
-            if len(f['organisationsNavn']) != 1:
-                print('more org navn')
-                pdb.set_trace()
-            parse_udggaende(f, 'Fusion')
+    for f in dat['fusioner']:
+        if len(f['organisationsNavn']) != 1:
+            add_error('Fusion more org names: enh {0}'.format(dat['enhedsNummer']))
+        parse_udggaende(f, 'Fusion', dat['enhedsNummer'])
 
 
 class SpaltFusionIndUdParser(Parser):
@@ -106,6 +102,9 @@ class SpaltningFusionParser(ParserInterface):
     def commit(self):
         self.indud_parser.commit()
 
+    def source_fields(self):
+        return {'enhedsNummer', 'spaltninger', 'fusioner'}
+
 
 class CompanyOrganisationParser(ParserInterface):
     """ 
@@ -134,6 +133,9 @@ class CompanyOrganisationParser(ParserInterface):
     def commit(self):
         self.name_parser.commit()
 
+    def source_fields(self):
+        return {'deltagerRelation', 'spaltninger', 'fusioner'}
+
 
 class PersonOrganisationParser(ParserInterface):
     """ Parse Organisation Objects which are on the form  
@@ -154,6 +156,9 @@ class PersonOrganisationParser(ParserInterface):
         self.org_parser.commit()
         self.member_parser.commit()
 
+    def source_fields(self):
+        return {'enhedsNummer', 'virksomhedSummariskRelation'}
+
 
 
 
@@ -189,6 +194,8 @@ class OrganisationNavnParser(ParserInterface):
 
     def commit(self):
         self.db.commit()
+        # keys are only skipped within a batch - the parser is reused for later batches
+        self.key_store.clear()
 
 
 class OrganisationAttributParser(Parser):
@@ -292,6 +299,9 @@ class CompanyOrganisationMemberParser(ParserInterface):
     def commit(self):
         self.member_parser.commit()
 
+    def source_fields(self):
+        return {'enhedsNummer', 'deltagerRelation'}
+
 
 class PersonOrganisationMemberParser(ParserInterface):
     def __init__(self):
@@ -310,6 +320,9 @@ class PersonOrganisationMemberParser(ParserInterface):
     def commit(self):
         self.member_parser.commit()
 
+    def source_fields(self):
+        return {'enhedsNummer', 'virksomhedSummariskRelation'}
+
 
 class OrganisationParser(ParserInterface):
     """
@@ -0,0 +1,238 @@
+""" Compact index of the unit versions in the database: enhedsnummer -> (samtId, sidstOpdateret)
+
+The index is three sorted numpy arrays instead of a dict of namedtuples (a few bytes per unit instead of
+a few hundred), looked up with searchsorted - one unit at a time or vectorized for many units.
+It is built once and shared with other processes through memory mapped .npy files that are attached read only.
+"""
+import datetime
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+import numpy as np
+import pytz
+
+epoch = datetime.datetime(year=1970, month=1, day=1)
+# sidstopdateret of units without one
+missing_time = np.iinfo(np.int64).min
+array_names = ('enh', 'samtid', 'sidstopdateret')
+# same fields as CvrConnection.update_info
+unit_version = namedtuple('unit_version', ['samtid', 'sidstopdateret'])
+
+
+def to_micros(dt):
+    """ datetime as microseconds since epoch - naive datetimes are utc
+
+    :param dt: datetime or None
+    :return: int
+    """
+    if dt is None:
+        return missing_time
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return (dt - epoch) // datetime.timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    """ Inverse of to_micros
+
+    :param micros: int, microseconds since epoch
+    :return: datetime (utc) or None
+    """
+    if micros == missing_time:
+        return None
+    return (epoch + datetime.timedelta(microseconds=int(micros))).replace(tzinfo=pytz.utc)
+
+
+class SamtidIndex(object):
+    """ Sorted arrays of enhedsnummer, samtId (int32) and sidstOpdateret (int64 microseconds) of the units.
+    Supports the dict operations used on the old samtid map (in, [], get, len), so it can replace it.
+    An index made by share or attach is memory mapped and pickles as its path, so it is cheap to pass
+    to pool workers and processes.
+    """
+
+    def __init__(self, enh, samtid, sidstopdateret, path=None):
+        """
+        :param enh: np.array int64, sorted enhedsnummer
+        :param samtid: np.array int32, samtId of the units
+        :param sidstopdateret: np.array int64, sidstOpdateret of the units in microseconds since epoch
+        :param path: str, directory of the memory mapped arrays - None if the index is in memory only
+        """
+        self.enh = enh
+        self.samtid = samtid
+        self.sidstopdateret = sidstopdateret
+        self.path = path
+
+    @staticmethod
+    def from_rows(rows):
+        """ Build index
+
+        :param rows: list of (enhedsnummer, samtid, sidstopdateret) tuples
+        :return: SamtidIndex
+        """
+        enh = np.fromiter((x[0] for x in rows), dtype=np.int64, count=len(rows))
+        samtid = np.fromiter((-1 if x[1] is None else x[1] for x in rows), dtype=np.int32, count=len(rows))
+        sidstopdateret = np.fromiter((to_micros(x[2]) for x in rows), dtype=np.int64, count=len(rows))
+        return SamtidIndex.from_arrays(enh, samtid, sidstopdateret)
+
+    @staticmethod
+    def from_row_chunks(chunks):
+        """ Build index from streamed rows - each chunk is converted to arrays as it arrives
+
+        :param chunks: iterable of lists of (enhedsnummer, samtid, sidstopdateret) tuples (sql_help.stream_query)
+        :return: SamtidIndex
+        """
+        parts = [SamtidIndex.from_rows(chunk) for chunk in chunks]
+        if len(parts) == 0:
+            return SamtidIndex.from_rows([])
+        return SamtidIndex.concatenate(parts)
+
+    @staticmethod
+    def from_arrays(enh, samtid, sidstopdateret):
+        """ Build index from unsorted arrays
+
+        :return: SamtidIndex
+        """
+        order = np.argsort(enh, kind='stable')
+        return SamtidIndex(enh[order], samtid[order], sidstopdateret[order])
+
+    @staticmethod
+    def concatenate(indexes):
+        """ Merge indexes (one for each table)
+
+        :param indexes: list of SamtidIndex
+        :return: SamtidIndex
+        """
+        return SamtidIndex.from_arrays(np.concatenate([x.enh for x in indexes]),
+                                       np.concatenate([x.samtid for x in indexes]),
+                                       np.concatenate([x.sidstopdateret for x in indexes]))
+
+    def share(self, directory=None):
+        """ Write the arrays to a temporary directory and memory map them.
+        Remove the files with remove when all processes are done with the index.
+
+        :param directory: str, parent directory - default is the temp directory
+        :return: SamtidIndex, memory mapped index
+        """
+        path = tempfile.mkdtemp(prefix='cvr_samtid_', dir=directory)
+        for name in array_names:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        return SamtidIndex.attach(path)
+
+    @staticmethod
+    def attach(path):
+        """ Memory map shared index read only
+
+        :param path: str, directory made by share
+        :return: SamtidIndex
+        """
+        # plain ndarray views of the maps - indexing numpy.memmap objects is slower
+        arrays = [np.asarray(np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in array_names]
+        return SamtidIndex(*arrays, path=path)
+
+    def remove(self):
+        """ Delete the files of a shared index """
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __reduce__(self):
+        if self.path is not None:
+            return SamtidIndex.attach, (self.path, )
+        return SamtidIndex, (self.enh, self.samtid, self.sidstopdateret)
+
+    def __len__(self):
+        return len(self.enh)
+
+    def position(self, enh):
+        """ Position of unit in arrays
+
+        :param enh: int, enhedsnummer
+        :return: int, position or -1 if the unit is not in the index
+        """
+        pos = int(np.searchsorted(self.enh, enh))
+        if pos < len(self.enh) and self.enh[pos] == enh:
+            return pos
+        return -1
+
+    def __contains__(self, enh):
+        return self.position(enh) >= 0
+
+    def __getitem__(self, enh):
+        pos = self.position(enh)
+        if pos < 0:
+            raise KeyError(enh)
+        return unit_version(samtid=int(self.samtid[pos]), sidstopdateret=from_micros(self.sidstopdateret[pos]))
+
+    def get(self, enh, default=None):
+        try:
+            return self[enh]
+        except KeyError:
+            return default
+
+    def get_samtid(self, enh, default=-1):
+        """ samtId of one unit
+
+        :param enh: int, enhedsnummer
+        :param default: int, returned if the unit is not in the index
+        :return: int
+        """
+        pos = self.position(enh)
+        return int(self.samtid[pos]) if pos >= 0 else default
+
+    def lookup(self, enh, default=-1):
+        """ samtId of many units - vectorized
+
+        :param enh: np.array or list of int, enhedsnummer
+        :param default: int, samtId of units not in the index
+        :return: np.array int64, samtId of each unit
+        """
+        enh = np.asarray(enh, dtype=np.int64)
+        result = np.full(len(enh), default, dtype=np.int64)
+        if len(self.enh) == 0 or len(enh) == 0:
+            return result
+        pos = np.searchsorted(self.enh, enh)
+        pos_clip = np.minimum(pos, len(self.enh) - 1)
+        found = self.enh[pos_clip] == enh
+        result[found] = self.samtid[pos_clip[found]]
+        return result
+
+    def newer(self, enh, samtid):
+        """ Which units have a newer samtId than in the index - vectorized
+
+        :param enh: np.array or list of int, enhedsnummer
+        :param samtid: np.array or list of int, downloaded samtId
+        :return: np.array bool
+        """
+        return np.asarray(samtid, dtype=np.int64) > self.lookup(enh)
+
+
+class IdIndex(object):
+    """ Sorted array of ids for membership tests - the compact version of a set of ints """
+
+    def __init__(self, ids):
+        """
+        :param ids: np.array int64, sorted ids
+        """
+        self.ids = ids
+
+    @staticmethod
+    def from_chunks(chunks):
+        """ Build index from streamed ids
+
+        :param chunks: iterable of lists of ids (or of rows with the id first)
+        :return: IdIndex
+        """
+        parts = [np.fromiter((x if np.isscalar(x) else x[0] for x in chunk), dtype=np.int64, count=len(chunk))
+                 for chunk in chunks]
+        ids = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.int64)
+        ids.sort()
+        return IdIndex(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, _id):
+        if _id is None:
+            return False
+        pos = int(np.searchsorted(self.ids, _id))
+        return pos < len(self.ids) and self.ids[pos] == _id
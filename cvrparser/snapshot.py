@@ -0,0 +1,273 @@
+""" Compressed, indexed snapshot of downloaded cvr documents
+
+A snapshot file is a header followed by compressed frames. Each frame holds json lines of documents
+(the _source of the elasticsearch hits, like the lines of the old JSONL dumps). A sidecar index file (.idx, numpy npz)
+maps enhedsnummer -> (frame, offset, length) and stores the number of units of each type, so single units can be read
+without decompressing the whole file and frames can be replayed in parallel.
+
+Frames are compressed with zstandard if installed, otherwise zlib.
+"""
+import os
+import struct
+import zlib
+import numpy as np
+import ujson as json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+snapshot_suffix = '.snap'
+magic = b'CVRSNAP1'
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+file_header = struct.Struct('<8sB')
+frame_header = struct.Struct('<II')  # compressed length, raw length
+unit_types = ('Vrvirksomhed', 'VrproduktionsEnhed', 'Vrdeltagerperson')
+
+
+def is_snapshot(filename):
+    return filename.endswith(snapshot_suffix)
+
+
+def index_filename(filename):
+    return filename + '.idx'
+
+
+def source_type(source):
+    """ Unit type of a downloaded document
+
+    :param source: dict, _source of elasticsearch hit
+    :return: str, unit type or None
+    """
+    for _type in unit_types:
+        if _type in source:
+            return _type
+    return None
+
+
+class SnapshotWriter(object):
+    """ Writes documents to a snapshot file and its index """
+
+    def __init__(self, filename, frame_bytes=2**22, level=3):
+        """
+        :param filename: str, name of snapshot file (.snap)
+        :param frame_bytes: int, uncompressed size of frames
+        :param level: int, compression level
+        """
+        self.filename = filename
+        self.frame_bytes = frame_bytes
+        if zstandard is not None:
+            self.codec = CODEC_ZSTD
+            self.compressor = zstandard.ZstdCompressor(level=level)
+        else:
+            self.codec = CODEC_ZLIB
+            self.compressor = None
+        self.level = level
+        self.f = open(filename, 'wb')
+        self.f.write(file_header.pack(magic, self.codec))
+        self.frame = []
+        self.frame_size = 0
+        self.frame_positions = []
+        self.enh = []
+        self.frame_ids = []
+        self.offsets = []
+        self.lengths = []
+        self.counts = {_type: 0 for _type in unit_types}
+
+    def add(self, source):
+        """ Add document
+
+        :param source: dict, _source of elasticsearch hit
+        """
+        _type = source_type(source)
+        if _type is None:
+            raise ValueError('Unknown unit type: {0}'.format(str(source)[0:1000]))
+        line = json.dumps(source).encode('utf-8') + b'\n'
+        self.enh.append(source[_type]['enhedsNummer'])
+        self.frame_ids.append(len(self.frame_positions))
+        self.offsets.append(self.frame_size)
+        self.lengths.append(len(line))
+        self.counts[_type] += 1
+        self.frame.append(line)
+        self.frame_size += len(line)
+        if self.frame_size >= self.frame_bytes:
+            self.write_frame()
+
+    def compress(self, raw):
+        if self.codec == CODEC_ZSTD:
+            return self.compressor.compress(raw)
+        return zlib.compress(raw, self.level)
+
+    def write_frame(self):
+        if self.frame_size == 0:
+            return
+        raw = b''.join(self.frame)
+        data = self.compress(raw)
+        self.frame_positions.append(self.f.tell())
+        self.f.write(frame_header.pack(len(data), len(raw)))
+        self.f.write(data)
+        self.frame = []
+        self.frame_size = 0
+
+    def close(self):
+        """ Write last frame and the index """
+        self.write_frame()
+        self.f.close()
+        enh = np.array(self.enh, dtype=np.int64)
+        order = np.argsort(enh, kind='stable')
+        counts = json.dumps(self.counts)
+        with open(index_filename(self.filename), 'wb') as f:
+            np.savez(f,
+                     enh=enh[order],
+                     frame=np.array(self.frame_ids, dtype=np.int32)[order],
+                     offset=np.array(self.offsets, dtype=np.int32)[order],
+                     length=np.array(self.lengths, dtype=np.int32)[order],
+                     frame_positions=np.array(self.frame_positions, dtype=np.int64),
+                     counts=np.array([counts]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SnapshotReader(object):
+    """ Reads snapshot files - full replay, single frames or single units """
+
+    def __init__(self, filename):
+        """
+        :param filename: str, name of snapshot file (.snap)
+        """
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            file_magic, self.codec = file_header.unpack(f.read(file_header.size))
+        if file_magic != magic:
+            raise ValueError('Not a cvr snapshot file: {0}'.format(filename))
+        if self.codec == CODEC_ZSTD and zstandard is None:
+            raise ImportError('Snapshot is zstd compressed - pip install zstandard')
+        with np.load(index_filename(filename)) as index:
+            self.enh = index['enh']
+            self.frame_ids = index['frame']
+            self.offsets = index['offset']
+            self.lengths = index['length']
+            self.frame_positions = index['frame_positions']
+            self.counts = json.loads(str(index['counts'][0]))
+        self.f = open(filename, 'rb')
+
+    def __len__(self):
+        return len(self.enh)
+
+    def frame_count(self):
+        return len(self.frame_positions)
+
+    def decompress(self, data, raw_length):
+        if self.codec == CODEC_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=raw_length)
+        return zlib.decompress(data)
+
+    def read_frame(self, frame):
+        """ Uncompressed frame
+
+        :param frame: int, frame number
+        :return: bytes, json lines
+        """
+        self.f.seek(int(self.frame_positions[frame]))
+        length, raw_length = frame_header.unpack(self.f.read(frame_header.size))
+        return self.decompress(self.f.read(length), raw_length)
+
+    def frame_sources(self, frame):
+        """ Documents of frame
+
+        :param frame: int, frame number
+        :return: list of dicts
+        """
+        return [json.loads(line) for line in self.read_frame(frame).splitlines()]
+
+    def __iter__(self):
+        """ Full replay - all documents in file order """
+        for frame in range(self.frame_count()):
+            yield from self.frame_sources(frame)
+
+    def get(self, enh):
+        """ Read single unit
+
+        :param enh: int, enhedsnummer
+        :return: dict, _source of the unit or None if it is not in the snapshot
+        """
+        pos = np.searchsorted(self.enh, enh)
+        if pos >= len(self.enh) or self.enh[pos] != enh:
+            return None
+        raw = self.read_frame(int(self.frame_ids[pos]))
+        offset = int(self.offsets[pos])
+        return json.loads(raw[offset:offset + int(self.lengths[pos])])
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_dump(filename):
+    """ Documents of a downloaded dump - snapshot or JSONL file
+
+    :param filename: str, .snap snapshot file or JSONL file
+    :return: generator of dicts
+    """
+    if is_snapshot(filename):
+        with SnapshotReader(filename) as reader:
+            yield from reader
+    else:
+        with open(filename) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def dump_chunks(filename, chunk_bytes=2**26):
+    """ Split a downloaded dump into chunks that can be read independently (in parallel)
+    Snapshots are split into ranges of frames, JSONL files into byte ranges aligned to line boundaries.
+
+    :param filename: str, .snap snapshot file or JSONL file
+    :param chunk_bytes: int, approximate size of JSONL chunks
+    :return: list of (start, end) tuples - frame numbers for snapshots, byte offsets for JSONL
+    """
+    if is_snapshot(filename):
+        with SnapshotReader(filename) as reader:
+            return [(frame, frame + 1) for frame in range(reader.frame_count())]
+    size = os.path.getsize(filename)
+    chunks = []
+    start = 0
+    with open(filename, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def read_dump_chunk(filename, chunk):
+    """ Documents of one chunk of a downloaded dump
+
+    :param filename: str, .snap snapshot file or JSONL file
+    :param chunk: (int, int), chunk from dump_chunks
+    :return: generator of dicts
+    """
+    start, end = chunk
+    if is_snapshot(filename):
+        with SnapshotReader(filename) as reader:
+            for frame in range(start, end):
+                yield from reader.frame_sources(frame)
+    else:
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            for line in f.read(end - start).splitlines():
+                if line.strip():
+                    yield json.loads(line)
@@ -0,0 +1,194 @@
+""" Queue between producers and consumers that is bounded by bytes in memory instead of number of items
+
+When the queue is full the producer does not block (a blocked scroll may time out on the server),
+instead the items are appended to an on disk segment file and a drain thread in the producer process
+moves them to the queue, in order, as the consumers free up space.
+"""
+import multiprocessing
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+
+record_header = struct.Struct('<Q')
+# guards the lazy creation of spill segments and drain threads - made anew in forked children, since another
+# thread may hold it at the time of the fork
+spill_lock = threading.Lock()
+
+
+def reset_spill_lock():
+    global spill_lock
+    spill_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_spill_lock)
+
+
+def item_size(obj):
+    """ Bytes an item takes up in the queue
+
+    :param obj: bytes (frames), str (sentinel) or other picklable object
+    :return: int
+    """
+    if type(obj) is bytes or type(obj) is str:
+        return len(obj)
+    return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class SpillSegment(object):
+    """ On disk fifo of the items that did not fit in the queue.
+    Written by put in the producer and read by the drain thread. The file is truncated whenever it is drained.
+    """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(prefix='cvr_spill_', suffix='.seg', dir=directory)
+        self.writer = os.fdopen(fd, 'wb')
+        self.reader = open(self.path, 'rb')
+        self.pending = 0
+        self.spilled = 0
+        self.cond = threading.Condition()
+
+    def append(self, size, obj):
+        """ Append item - call with cond held """
+        payload = pickle.dumps((size, obj), protocol=pickle.HIGHEST_PROTOCOL)
+        self.writer.write(record_header.pack(len(payload)))
+        self.writer.write(payload)
+        self.writer.flush()
+        self.pending += 1
+        self.spilled += 1
+        self.cond.notify_all()
+
+    def peek(self):
+        """ Read next item - call with cond held and pending > 0
+
+        :return: (int, object), size and item
+        """
+        pos = self.reader.tell()
+        length, = record_header.unpack(self.reader.read(record_header.size))
+        size, obj = pickle.loads(self.reader.read(length))
+        self.reader.seek(pos)
+        return size, obj
+
+    def pop(self):
+        """ Skip past item returned by peek - call with cond held """
+        length, = record_header.unpack(self.reader.read(record_header.size))
+        self.reader.seek(length, os.SEEK_CUR)
+        self.pending -= 1
+        if self.pending == 0:
+            self.writer.seek(0)
+            self.writer.truncate()
+            self.reader.seek(0)
+        self.cond.notify_all()
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+        os.remove(self.path)
+
+
+class ByteBoundedQueue(object):
+    """ multiprocessing.Queue holding at most max_bytes in memory - overflow is spilled to disk.
+    Can be passed to other processes like multiprocessing.Queue. Producers must call flush before they exit.
+    """
+
+    def __init__(self, max_bytes=2**30, spill_dir=None):
+        """
+        :param max_bytes: int, max bytes of items in the queue
+        :param spill_dir: str, directory for spill segment files - default is the temp directory
+        """
+        self.queue = multiprocessing.Queue()
+        self.bytes = multiprocessing.Value('q', 0)
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.pid = None
+        self.spill = None
+        self.drainer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pid'] = None
+        state['spill'] = None
+        state['drainer'] = None
+        return state
+
+    def reserve(self, size):
+        """ Reserve room for item - an item is always let through if the queue is empty """
+        with self.bytes.get_lock():
+            if self.bytes.value + size <= self.max_bytes or self.bytes.value == 0:
+                self.bytes.value += size
+                return True
+        return False
+
+    def get_spill(self):
+        """ Spill segment and drain thread of this process - made on first use.
+        pid is set last, so other threads only use the segment once it and its drain thread exist.
+        """
+        pid = os.getpid()
+        if self.pid == pid:
+            return self.spill
+        with spill_lock:
+            if self.pid != pid:
+                spill = SpillSegment(self.spill_dir)
+                drainer = threading.Thread(target=self.drain, args=(spill,), daemon=True)
+                drainer.start()
+                self.spill = spill
+                self.drainer = drainer
+                self.pid = pid
+        return self.spill
+
+    def drain(self, spill):
+        """ Move spilled items to the queue in order when there is room """
+        while True:
+            with spill.cond:
+                while spill.pending == 0:
+                    spill.cond.wait()
+                size, obj = spill.peek()
+            while not self.reserve(size):
+                time.sleep(0.05)
+            with spill.cond:
+                self.queue.put((size, obj))
+                spill.pop()
+
+    def put(self, obj, timeout=None):
+        """ Put item on queue or spill it to disk - never blocks on a full queue
+
+        :param obj: item
+        :param timeout: not used - for compatibility with multiprocessing.Queue
+        """
+        size = item_size(obj)
+        spill = self.get_spill()
+        with spill.cond:
+            if spill.pending == 0 and self.reserve(size):
+                self.queue.put((size, obj))
+                return
+            if spill.spilled == 0:
+                print('Queue full ({0} bytes) - spilling to {1}'.format(self.bytes.value, spill.path))
+            spill.append(size, obj)
+
+    def get(self, timeout=None):
+        size, obj = self.queue.get(timeout=timeout)
+        with self.bytes.get_lock():
+            self.bytes.value -= size
+        return obj
+
+    def flush(self):
+        """ Wait until all spilled items of this process are in the queue """
+        if self.pid != os.getpid():
+            return
+        spill = self.spill
+        with spill.cond:
+            while spill.pending > 0:
+                spill.cond.wait()
+        if spill.spilled > 0:
+            print('Spilled {0} queue items to disk - all drained'.format(spill.spilled))
+
+    def full(self):
+        return self.bytes.value >= self.max_bytes
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.flush()
+            self.spill.close()
+        self.queue.close()
@@ -1,10 +1,183 @@
-from sqlalchemy import tuple_
+from sqlalchemy import tuple_, Integer, Column, MetaData, Table, and_, select
 from . import create_session
 from contextlib import closing
 from .bug_report import add_error
+from array import array
+import itertools
 import os
 import logging
 
+
+def stream_query(query, chunk_size=2**16):
+    """ Read the rows of a query in chunks with a server side cursor (stream_results),
+    so the full result is never held by the database driver or in one list
+
+    :param query: sqlalchemy.orm.Query
+    :param chunk_size: int, rows fetched at a time
+    :return: generator of lists of rows
+    """
+    rows = iter(query.yield_per(chunk_size))
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class ColumnBuffer(object):
+    """ Rows stored column by column instead of a tuple (and at commit a dict) per row.
+    Integer columns are kept in int64 arrays, until a value that is not an int (None) is added and the column
+    becomes a list. The other columns are lists.
+    """
+
+    def __init__(self, columns):
+        """
+        :param columns: list of columns, defines the rows
+        """
+        self.integer = [isinstance(c.type, Integer) for c in columns]
+        self.positions = range(len(columns))
+        self.clear()
+
+    def clear(self):
+        self.buffers = [array('q') if x else [] for x in self.integer]
+        self.appends = [x.append for x in self.buffers]
+        self.size = 0
+
+    def append(self, row):
+        """ Add row - like zip values after the last column are dropped and missing values are None
+
+        :param row: tuple, a value for each column
+        """
+        appends = self.appends
+        i = -1
+        for i, x in zip(self.positions, row):
+            try:
+                appends[i](x)
+            except (TypeError, OverflowError):
+                self.to_list(i)
+                appends[i](x)
+        for j in range(i + 1, len(appends)):
+            self.to_list(j)
+            appends[j](None)
+        self.size += 1
+
+    def to_list(self, i):
+        """ Keep column in a list from now on - it has a value that is not an int64 """
+        if type(self.buffers[i]) is not list:
+            self.buffers[i] = list(self.buffers[i])
+            self.appends[i] = self.buffers[i].append
+
+    def __len__(self):
+        return self.size
+
+    def rows(self):
+        return zip(*self.buffers)
+
+
+insert_statements = {}
+
+
+def insert_columns(session, table_class, fields, columns):
+    """ Insert rows given column by column with one executemany - there is no dict per row like in
+    bulk_insert_mappings(render_nulls=True). The bind processors of the column types are applied column by column.
+    Falls back to bulk_insert_mappings for drivers with named parameters and tables with python side defaults.
+
+    :param session: sqlalchemy session, the insert is part of its transaction
+    :param table_class: alchemy_tables class or Table
+    :param fields: list of str, column names
+    :param columns: list of sequences, values of each column
+    """
+    if len(columns) == 0 or len(columns[0]) == 0:
+        return
+    connection = session.connection()
+    dialect = connection.dialect
+    statement_key = (table_class, tuple(fields), dialect.name)
+    if statement_key not in insert_statements:
+        table = getattr(table_class, '__table__', table_class)
+        compiled = table.insert().compile(dialect=dialect, column_keys=fields)
+        if compiled.positional and sorted(compiled.positiontup) == sorted(fields):
+            processors = [table.c[name].type.dialect_impl(dialect).bind_processor(dialect)
+                          for name in compiled.positiontup]
+            order = [fields.index(name) for name in compiled.positiontup]
+            insert_statements[statement_key] = (compiled.string, order, processors)
+        else:
+            insert_statements[statement_key] = None
+    statement = insert_statements[statement_key]
+    if statement is None:
+        rows = [{x: y for (x, y) in zip(fields, row)} for row in zip(*columns)]
+        if isinstance(table_class, Table):
+            connection.execute(table_class.insert(), rows)
+        else:
+            session.bulk_insert_mappings(table_class, rows, render_nulls=True)
+        return
+    sql, order, processors = statement
+    ordered = [columns[i] if processor is None else map(processor, columns[i])
+               for (i, processor) in zip(order, processors)]
+    cursor = connection.connection.cursor()
+    try:
+        cursor.executemany(sql, list(zip(*ordered)))
+    finally:
+        cursor.close()
+
+
+staging_tables = {}
+
+
+def staging_table(table_class, fields, key_fields, id_field):
+    """ Temporary table for new rows of a dimension table - the given columns and the position of the row.
+    Made once with the statements that insert the new rows and read the ids.
+
+    :param table_class: alchemy_tables class
+    :param fields: list of str, column names
+    :param key_fields: list of str, the key columns - a subset of fields
+    :param id_field: str, id column
+    :return: Table (staging table), insert of the rows not in the dimension table, select of (position, id)
+    """
+    key = (table_class, tuple(fields))
+    if key not in staging_tables:
+        table = table_class.__table__
+        columns = [Column('stagepos', Integer, nullable=False)] + [Column(x, table.c[x].type) for x in fields]
+        stage = Table('stage_{0}'.format(table.name), MetaData(), *columns, prefixes=['TEMPORARY'])
+        on = and_(*[stage.c[x] == table.c[x] for x in key_fields])
+        new_rows = select(*[stage.c[x] for x in fields]).select_from(stage.outerjoin(table, on))
+        new_rows = new_rows.where(table.c[id_field].is_(None)).distinct()
+        ids = select(stage.c.stagepos, table.c[id_field]).select_from(stage.join(table, on))
+        staging_tables[key] = (stage, table.insert().from_select(fields, new_rows), ids)
+    return staging_tables[key]
+
+
+def resolve_dimension(session, table_class, fields, columns, key_fields, id_field):
+    """ Insert the rows of a dimension table whose keys are not in it and get the ids of all the rows.
+    The rows are loaded into a temporary staging table, the missing ones are inserted with one insert select and
+    the ids are read back with one join - no IN lists of the keys. The staging table is made once per connection
+    and emptied before each use - rows of an earlier batch may be left in it, e.g. after a rollback.
+
+    :param session: sqlalchemy session, all is part of its transaction
+    :param table_class: alchemy_tables class, dimension table
+    :param fields: list of str, column names of the rows
+    :param columns: list of sequences, values of each column
+    :param key_fields: list of str, the key columns - a subset of fields
+    :param id_field: str, id column
+    :return: list of (position, id) tuples, position is the index of the row in columns
+    """
+    connection = session.connection()
+    stage, insert_new, select_ids = staging_table(table_class, fields, key_fields, id_field)
+    created = connection.info.setdefault('staging_tables', set())
+    try:
+        if stage.name not in created:
+            stage.create(connection, checkfirst=True)
+            created.add(stage.name)
+        # always - a rollback does not drop a temporary table on mysql but brings back the rows deleted before
+        connection.execute(stage.delete())
+        insert_columns(session, stage, ['stagepos'] + fields, [range(len(columns[0]))] + list(columns))
+        connection.execute(insert_new)
+        return connection.execute(select_ids).fetchall()
+    except Exception:
+        # on sqlite the table is gone with the rolled back transaction - check again next time
+        created.discard(stage.name)
+        raise
+
+
 class MyCache(object):
     """ Change to use async inserts perhaps - that would be neat
     https://further-reading.net/2017/01/quick-tutorial-python-multiprocessing/
@@ -21,7 +194,7 @@ class SessionCache(MyCache):
     def __init__(self, table_class, columns, batch_size=1000):
         self.columns = columns
         self.fields = [x.name for x in columns]
-        self.cache = []
+        self.cache = ColumnBuffer(columns)
         self.batch_size = batch_size
         self.table_class = table_class
 
@@ -41,57 +214,63 @@ class SessionInsertCache(SessionCache):
         super().__init__(table_class, columns, batch_size)
 
     def commit(self):
-        z = [{x: y for (x, y) in zip(self.fields, c)} for c in self.cache]
-        # objs = [self.table_class(**d) for d in z]
-        # self.session.add_all(objs)
         # t0 = time.time()
-        with closing(create_session()) as session:
-            session.bulk_insert_mappings(self.table_class, z, render_nulls=True)
-            session.commit()
+        if len(self.cache) > 0:
+            with closing(create_session()) as session:
+                insert_columns(session, self.table_class, self.fields, self.cache.buffers)
+                session.commit()
         # t1 = time.time()
         # total = t1 - t0
         # print('insert cache', self.table_class)
-        self.cache = []
+        self.cache.clear()
 
 
 class SessionKeystoreCache(SessionCache):
     def __init__(self, table_class, columns, keystore, batch_size=1000):
         super().__init__(table_class, columns, batch_size)
         self.keystore = keystore
+        self.keys = []
+
+    def insert(self, val):
+        """ Add row
+
+        :param val: (key, data) - data is inserted if the key is still not in the database at commit
+        """
+        key, dat = val
+        self.keys.append(key)
+        self.cache.append(dat)
 
     def commit(self):
-        # t0 = time.time()
-        # session = create_session()
-        # does not update the keystore which may be a problem
+        """ Insert the rows whose keys are not in the database and map all the keys to their ids
+        (see resolve_dimension) """
+        if len(self.keys) == 0:
+            return
         success = False
         for i in range(3):
-            missing = sorted(self.keystore.update())
             session = create_session()
             try:
-                z = [{x: y for (x, y) in zip(self.fields, c)} for (key, c) in self.cache if key in missing]
-                session.bulk_insert_mappings(self.table_class, z, render_nulls=True)
+                ids = resolve_dimension(session, self.table_class, self.fields, self.cache.buffers,
+                                        self.keystore.key_fields, self.keystore.val.name)
                 session.commit()
+                self.keystore.resolve({self.keys[pos]: _id for (pos, _id) in ids})
                 success = True
                 break
             except Exception as e:
-                #logger = logging.getLogger('consumer-{0}'.format(os.getpid()))
-                #logger.debug('Session Keystore Cache Error: e: {0}'.format(e))
                 add_error('SessionKeyStoreCache: \n{0} - attempt {1}'.format(e, i))
                 session.rollback()
 
                 if i == 2:
-                    add_error('SessionKeyStoreCache: \n{0} - attempt {1} - data {2} '.format(e, i, str(z)))
-                    for x in z:
-                        print(z)
+                    add_error('SessionKeyStoreCache: \n{0} - attempt {1} - data {2} '.format(e, i,
+                                                                                           list(self.cache.rows())))
+                    for x in self.cache.rows():
+                        print(x)
             finally:
                 session.close()
-        # t1 = time.time()
-        # total = t1 - t0
-        # print('keystore cache', self.table_class)
         if success:
-            self.cache = []
+            self.keys = []
+            self.cache.clear()
         else:
-            raise Exception('CANNOT INSERT {0}'.format(z))
+            raise Exception('CANNOT INSERT {0}'.format(list(self.cache.rows())))
 
 
 class SessionUpdateCache(SessionCache):
@@ -105,6 +284,8 @@ class SessionUpdateCache(SessionCache):
         super().__init__(table_class, key_columns+data_columns, batch_size)
         self.key_columns = key_columns
         self.data_columns = data_columns
+        # rows are sorted by key at commit so they are kept as (key, data) tuples
+        self.cache = []
 
     def commit(self):
         """ It not exists insert, else update
@@ -26,4 +26,7 @@ setup(
         'ujson>=1.35',
         'urllib3>=1.22'
     ],
+    extras_require={
+        'snapshot': ['zstandard'],
+    },
 )
\ No newline at end of file